@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Load test for the bot handlers.
+
+Feeds synthetic Updates through the real Application (start, message_router,
+callback_query_handler) against a local PostgreSQL, with the Telegram Bot API
+replaced by an in-process stub, and prints per update type:
+throughput, p50/p95/p99 handler latency, DB round-trips and Bot API calls.
+
+Simulated users get telegram_ids from --id-base upwards; rows in that range
+are deleted before the run (and after it unless --keep), so point it at a
+scratch database or at least an id range no real user has.
+
+    DATABASE_URL=postgresql://postgres@127.0.0.1:5432/bot DB_SSLMODE=disable \\
+    BOT_TOKEN=123:abc ADMIN_ID=1 python benchmarks/bench_handlers.py --users 2000
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import psycopg2.extensions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import money_tree_bot as bot  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import ApplicationBuilder  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+
+# --- DB ROUND-TRIP COUNTING ---
+
+_counter_lock = threading.Lock()
+DB_TRIPS = {"execute": 0, "commit": 0}
+
+
+def _count(kind):
+    with _counter_lock:
+        DB_TRIPS[kind] += 1
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    def execute(self, query, vars=None):
+        _count("execute")
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        _count("execute")
+        return super().executemany(query, vars_list)
+
+
+class CountingConnection(bot.PreparingConnection):
+    """Counts every statement and commit/rollback sent to the server."""
+
+    def cursor(self, *args, **kwargs):
+        kwargs.setdefault("cursor_factory", CountingCursor)
+        return super().cursor(*args, **kwargs)
+
+    def commit(self):
+        _count("commit")
+        return super().commit()
+
+    def rollback(self):
+        _count("commit")
+        return super().rollback()
+
+
+def db_trips():
+    with _counter_lock:
+        return DB_TRIPS["execute"] + DB_TRIPS["commit"]
+
+
+# --- STUB BOT API ---
+
+class StubRequest(BaseRequest):
+    """Answers Bot API calls locally with just enough JSON for the handlers."""
+
+    def __init__(self):
+        self.calls = 0
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id") or 0)
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": params.get("text") or "",
+        }
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        self.calls += 1
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            result = self._message(params)
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+# --- SYNTHETIC UPDATES ---
+
+_update_ids = itertools.count(1)
+
+
+def _user(tid):
+    return {"id": tid, "is_bot": False, "first_name": f"User{tid % 100000}", "username": f"u{tid}"}
+
+
+def message_update(tid, text):
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(time.time()),
+        "chat": {"id": tid, "type": "private"},
+        "from": _user(tid),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(tid, data):
+    return {
+        "update_id": next(_update_ids),
+        "callback_query": {
+            "id": str(next(_update_ids)),
+            "from": _user(tid),
+            "chat_instance": str(tid),
+            "data": data,
+            "message": {
+                "message_id": next(_update_ids),
+                "date": int(time.time()),
+                "chat": {"id": tid, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "Bench"},
+                "text": "ড্যাশবোর্ড",
+            },
+        },
+    }
+
+
+# --- RUNNER ---
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.errors = 0
+        self.elapsed = 0.0
+        self.db_trips = 0
+        self.api_calls = 0
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000
+
+    def row(self):
+        n = len(self.latencies)
+        return {
+            "update": self.name,
+            "count": n,
+            "errors": self.errors,
+            "per_sec": round(n / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(self.percentile(0.50), 2),
+            "p95_ms": round(self.percentile(0.95), 2),
+            "p99_ms": round(self.percentile(0.99), 2),
+            "max_ms": round(self.percentile(1.0), 2),
+            "db_per_update": round(self.db_trips / n, 2) if n else 0.0,
+            "api_per_update": round(self.api_calls / n, 2) if n else 0.0,
+        }
+
+
+class Bench:
+    def __init__(self, app, stub, concurrency):
+        self.app = app
+        self.stub = stub
+        self.concurrency = concurrency
+        self.current = None
+        self.results = []
+
+    async def on_error(self, update, context):
+        if self.current is not None:
+            self.current.errors += 1
+        logging.getLogger("bench").debug("Handler error: %s", context.error)
+
+    async def send(self, payload):
+        update = Update.de_json(payload, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.current.latencies.append(time.perf_counter() - started)
+
+    async def run(self, name, users, script):
+        """
+        Runs `script(tid)` (a list of update payloads, sent in order) for every
+        user, `concurrency` users at a time. Write-behind work (ledger entries,
+        conversation state) is flushed before the phase ends so its round-trips
+        are charged to the updates that caused it.
+        """
+        phase = self.current = Phase(name)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one_user(tid):
+            async with semaphore:
+                for payload in script(tid):
+                    await self.send(payload)
+
+        trips, calls = db_trips(), self.stub.calls
+        started = time.perf_counter()
+        await asyncio.gather(*(one_user(tid) for tid in users))
+        phase.elapsed = time.perf_counter() - started
+        await bot.LEDGER.flush()
+        await self.app.update_persistence()
+        await bot.CONVERSATION_STATE.flush()
+        phase.db_trips = db_trips() - trips
+        phase.api_calls = self.stub.calls - calls
+        self.current = None
+        self.results.append(phase.row())
+        print(f"  {name}: {len(phase.latencies)} updates in {phase.elapsed:.2f}s", file=sys.stderr)
+
+
+def cleanup(first_id, last_id):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        for table in ("withdrawals", "balance_ledger", "conversation_state", "users"):
+            cur.execute(f"DELETE FROM {table} WHERE telegram_id BETWEEN %s AND %s", (first_id, last_id))
+        conn.commit()
+    bot.USER_CACHE.invalidate(*range(first_id, last_id + 1))
+
+
+def print_table(rows):
+    columns = list(rows[0])
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) if c == "update" else c.rjust(widths[c]) for c in columns))
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(widths[c]) if c == "update" else str(r[c]).rjust(widths[c]) for c in columns))
+
+
+async def main(args):
+    rng = random.Random(args.seed)
+    users = list(range(args.id_base, args.id_base + args.users))
+    first_wave, second_wave = users[: len(users) // 2], users[len(users) // 2:]
+    withdraw_users = users[: args.withdraw_users]
+
+    if not args.throttle:
+        # Simulated users tap far faster than people; measure the DB path instead
+        bot.THROTTLE.buckets.clear()
+    await asyncio.get_running_loop().run_in_executor(bot.DB_EXECUTOR, bot.init_db)
+    cleanup(users[0], users[-1])
+
+    stub = StubRequest()
+    app = (
+        ApplicationBuilder()
+        .token(bot.BOT_TOKEN or "123:bench")
+        .request(stub)
+        .get_updates_request(stub)
+        .persistence(bot.CONVERSATION_STATE)
+        .build()
+    )
+    bot.add_handlers(app)
+    bench = Bench(app, stub, args.concurrency)
+    app.add_error_handler(bench.on_error)
+
+    await app.initialize()
+    bot.LEDGER.start()
+    try:
+        print(f"Running with {args.users} users, concurrency {args.concurrency}", file=sys.stderr)
+        await bench.run("/start", first_wave, lambda tid: [message_update(tid, "/start")])
+        await bench.run(
+            "/start <ref>", second_wave, lambda tid: [message_update(tid, f"/start {rng.choice(first_wave)}")]
+        )
+        await bench.run("/start (again)", users, lambda tid: [message_update(tid, "/start")])
+        await bench.run("dashboard", users, lambda tid: [message_update(tid, "💰 ইনকাম শুরু করুন")])
+        await bench.run("referral", users, lambda tid: [message_update(tid, "👥 রেফারেল সিস্টেম")])
+        await bench.run("watch_ad", users, lambda tid: [callback_update(tid, "watch_ad")])
+        await bench.run("ad_finished", users, lambda tid: [callback_update(tid, "ad_finished")] * args.tasks)
+        await bench.run("withdraw: menu", withdraw_users, lambda tid: [message_update(tid, "💸 উইথড্র")])
+        await bench.run(
+            "withdraw: amount", withdraw_users, lambda tid: [message_update(tid, str(bot.MIN_WITHDRAW))]
+        )
+        await bench.run("withdraw: method", withdraw_users, lambda tid: [message_update(tid, "Bkash")])
+        await bench.run("withdraw: account", withdraw_users, lambda tid: [message_update(tid, "01700000000")])
+    finally:
+        await bot.LEDGER.stop()
+        await app.shutdown()
+        if not args.keep:
+            cleanup(users[0], users[-1])
+
+    print_table(bench.results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"users": args.users, "concurrency": args.concurrency, "tasks": args.tasks, "results": bench.results},
+                f, indent=2,
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1000, help="simulated users")
+    parser.add_argument("--concurrency", type=int, default=bot.CONCURRENT_UPDATES,
+                        help="users whose updates are in flight at once")
+    parser.add_argument("--tasks", type=int, default=bot.DAILY_TASK_LIMIT + 5,
+                        help="ad_finished callbacks per user (past the daily limit by default)")
+    parser.add_argument("--withdraw-users", type=int, default=None,
+                        help="users that go through the withdraw flow (default: all)")
+    parser.add_argument("--id-base", type=int, default=9_000_000_000, help="first simulated telegram_id")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--throttle", action="store_true",
+                        help="keep the per-user tap throttling (by default only the daily-limit flag stays on)")
+    parser.add_argument("--keep", action="store_true", help="leave the simulated users in the database")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    args = parser.parse_args(argv)
+    if args.withdraw_users is None:
+        args.withdraw_users = args.users
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # Must be in place before the pools open their first connection
+    for params in (bot.DB_PARAMS, bot.REPLICA_PARAMS):
+        if params is not None:
+            params["connection_factory"] = CountingConnection
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the user/withdrawal data-access layer.
+
+Compares the hot queries as they used to run (SELECT * into a tuple, parsed
+and planned by Postgres on every call) with the current helpers (only the
+needed columns into a UserRecord, as prepared statements), against a local
+PostgreSQL, and prints per variant: calls/s and p50/p95/p99 latency. It also
+measures the Python memory one fetched user takes as a tuple vs a record.
+
+Users get telegram_ids from --id-base upwards; rows in that range are deleted
+before and after the run, so point it at a scratch database.
+
+    DATABASE_URL=postgresql://postgres@127.0.0.1:5432/bot DB_SSLMODE=disable \\
+    BOT_TOKEN=123:abc ADMIN_ID=1 python benchmarks/bench_user_records.py --calls 20000
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import money_tree_bot as bot  # noqa: E402
+
+
+# --- THE OLD HELPERS ---
+
+def legacy_get_user(telegram_id):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE telegram_id=%s", (telegram_id,))
+        return cur.fetchone()
+
+
+def legacy_get_balance(telegram_id):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT balance FROM users WHERE telegram_id=%s", (telegram_id,))
+        row = cur.fetchone()
+        return row[0] if row else 0
+
+
+def legacy_credit_task(telegram_id):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            WITH credited AS (
+                UPDATE users
+                SET tasks_done_count = CASE WHEN tasks_done_date = %(today)s
+                                            THEN tasks_done_count + 1 ELSE 1 END,
+                    tasks_done_date = %(today)s
+                WHERE telegram_id = %(tid)s
+                  AND (tasks_done_date IS DISTINCT FROM %(today)s OR tasks_done_count < %(limit)s)
+                RETURNING tasks_done_count, balance
+            )
+            SELECT tasks_done_count, balance, TRUE FROM credited
+            UNION ALL
+            SELECT tasks_done_count, balance, FALSE FROM users
+            WHERE telegram_id = %(tid)s AND NOT EXISTS (SELECT 1 FROM credited)
+            """,
+            {"tid": telegram_id, "today": datetime.date.today(), "limit": bot.DAILY_TASK_LIMIT},
+        )
+        row = cur.fetchone()
+        conn.commit()
+        return row
+
+
+# --- RUNNER ---
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000 if ordered else 0.0
+
+
+def measure(name, func, ids, threads):
+    """Calls func(tid) once per id from `threads` threads and returns a result row."""
+    latencies = []
+
+    def one(tid):
+        started = time.perf_counter()
+        func(tid)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = sorted(pool.map(one, ids))
+    elapsed = time.perf_counter() - started
+    print(f"  {name}: {len(ids)} calls in {elapsed:.2f}s", file=sys.stderr)
+    return {
+        "variant": name,
+        "calls": len(ids),
+        "per_sec": round(len(ids) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50), 3),
+        "p95_ms": round(percentile(latencies, 0.95), 3),
+        "p99_ms": round(percentile(latencies, 0.99), 3),
+    }
+
+
+def unprepared(func):
+    """Marks a current helper to run with DB_PREPARED_STATEMENTS off, to separate the two effects."""
+
+    def call(tid):
+        return func(tid)
+
+    call.prepared = False
+    return call
+
+
+def cache_memory(first_id, last_id):
+    """Python heap per fetched user, as a SELECT * tuple and as a UserRecord."""
+    sizes = {}
+    for name, columns, as_records in (("tuple", "*", False), ("UserRecord", bot.UserRecord.COLUMNS, True)):
+        with bot.get_conn() as conn:
+            cur = conn.cursor()
+            tracemalloc.start()
+            cur.execute(f"SELECT {columns} FROM users WHERE telegram_id BETWEEN %s AND %s", (first_id, last_id))
+            rows = [bot.UserRecord(*row) for row in cur.fetchall()] if as_records else cur.fetchall()
+            sizes[name] = tracemalloc.get_traced_memory()[0] // len(rows)
+            tracemalloc.stop()
+            del rows
+    return sizes
+
+
+def seed(first_id, count):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO users (telegram_id, first_name, username, balance, bonus_given, referrals_count)
+            SELECT g, 'User' || g, 'u' || g, 50, 1, g %% 7 FROM generate_series(%s::bigint, %s::bigint) AS g
+            """,
+            (first_id, first_id + count - 1),
+        )
+        conn.commit()
+
+
+def cleanup(first_id, last_id):
+    with bot.get_conn() as conn:
+        cur = conn.cursor()
+        for table in ("balance_ledger", "users"):
+            cur.execute(f"DELETE FROM {table} WHERE telegram_id BETWEEN %s AND %s", (first_id, last_id))
+        conn.commit()
+    bot.USER_CACHE.invalidate(*range(first_id, last_id + 1))
+
+
+def print_table(rows):
+    columns = list(rows[0])
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) if c == "variant" else c.rjust(widths[c]) for c in columns))
+    for r in rows:
+        print("  ".join(str(r[c]).ljust(widths[c]) if c == "variant" else str(r[c]).rjust(widths[c]) for c in columns))
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    users = list(range(args.id_base, args.id_base + args.users))
+    bot.init_db()
+    cleanup(users[0], users[-1])
+    seed(users[0], args.users)
+
+    def uncached_get_user(tid):
+        # Measure the query, not the cache in front of it
+        bot.USER_CACHE.invalidate(tid)
+        return bot.get_user.sync(tid)
+
+    variants = [
+        ("get_user: SELECT * tuple", legacy_get_user),
+        ("get_user: record", unprepared(uncached_get_user)),
+        ("get_user: record, prepared", uncached_get_user),
+        ("get_balance: plain", legacy_get_balance),
+        ("get_balance: prepared", bot.get_balance.sync),
+        ("credit_task: plain", legacy_credit_task),
+        ("credit_task: prepared", bot.credit_task.sync),
+    ]
+    results = []
+    try:
+        # Open the pool's connections up front so no variant pays for them
+        conns = [bot.get_pool().getconn() for _ in range(args.threads)]
+        for conn in conns:
+            bot.get_pool().putconn(conn)
+        for name, func in variants:
+            ids = [rng.choice(users) for _ in range(args.calls)]
+            bot.DB_PREPARED_STATEMENTS = getattr(func, "prepared", True)
+            measure(name, func, ids[: args.calls // 10], args.threads)  # warm-up
+            results.append(measure(name, func, ids, args.threads))
+        bot.DB_PREPARED_STATEMENTS = True
+        memory = cache_memory(users[0], users[-1])
+    finally:
+        cleanup(users[0], users[-1])
+
+    print_table(results)
+    print("Memory per fetched user: " + ", ".join(f"{name} {size} B" for name, size in memory.items()))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {"users": args.users, "calls": args.calls, "threads": args.threads,
+                 "results": results, "bytes_per_user": memory},
+                f, indent=2,
+            )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=5000, help="users seeded in the id range")
+    parser.add_argument("--calls", type=int, default=20000, help="calls per variant")
+    parser.add_argument("--threads", type=int, default=bot.DB_POOL_MAX,
+                        help="threads calling the helpers at once (like DB_EXECUTOR)")
+    parser.add_argument("--id-base", type=int, default=9_100_000_000, help="first seeded telegram_id")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.WARNING)
+    main(parse_args())
@@ -3,11 +3,33 @@
 SmartEarnbdBot - FINAL CODE for PostgreSQL (psycopg2) and Render deployment.
 """
 
+import argparse
 import logging
 import os
 import datetime
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import hmac
+import http
+import json
+import re
+import secrets
+import signal
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 # PostgreSQL Libraries
 import psycopg2 
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 from urllib.parse import urlparse
 # Telegram Libraries
 from dotenv import load_dotenv
@@ -15,18 +37,25 @@ from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputFile,
     KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
+    BasePersistence,
+    BaseUpdateProcessor,
+    PersistenceInput,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 
 # Load env
 load_dotenv()
@@ -37,10 +66,88 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID") or 0) 
 REF_BONUS = int(os.getenv("REF_BONUS") or 10)
 MIN_WITHDRAW = int(os.getenv("MIN_WITHDRAW") or 200)
+# Pending withdrawals shown per /withdraws page
+WITHDRAW_PAGE_SIZE = int(os.getenv("WITHDRAW_PAGE_SIZE") or 10)
 DAILY_TASK_LIMIT = int(os.getenv("DAILY_TASK_LIMIT") or 30)
 SIGNUP_BONUS = int(os.getenv("SIGNUP_BONUS") or 50) 
 TASK_REWARD = int(os.getenv("TASK_REWARD") or 5) 
 
+# Connection pool sizing (per process)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN") or 1)
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX") or 10)
+# Connections opened in parallel at startup, before the first update arrives
+# (prepare_db keeps it between the pool's min and max)
+DB_POOL_WARM = int(os.getenv("DB_POOL_WARM") or 4)
+# Seconds a caller may wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT") or 10)
+# Idle connections older than this (seconds) are pinged before being handed out
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE") or 30)
+# How often (seconds) pool statistics are written to the log; 0 disables
+DB_POOL_STATS_INTERVAL = int(os.getenv("DB_POOL_STATS_INTERVAL") or 300)
+# Hot queries run as server-side prepared statements; set to 0 behind a
+# transaction-mode pooler (PgBouncer) where sessions are not kept per client
+DB_PREPARED_STATEMENTS = (os.getenv("DB_PREPARED_STATEMENTS") or "1") != "0"
+# Read replica (DATABASE_URL_REPLICA): after a write, that user's reads stay on
+# the primary for this long (s) so they see it despite replication lag
+REPLICA_READ_YOUR_WRITES = float(os.getenv("REPLICA_READ_YOUR_WRITES") or 5)
+# A replica that failed is skipped (reads go to the primary) for this long (s)
+REPLICA_RETRY_INTERVAL = float(os.getenv("REPLICA_RETRY_INTERVAL") or 30)
+# Short, so an unreachable replica fails over quickly
+REPLICA_CONNECT_TIMEOUT = int(os.getenv("REPLICA_CONNECT_TIMEOUT") or 3)
+# Per-user row cache for the dashboard/referral screens
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE") or 10000)
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL") or 60)
+# Per-user button throttling: bucket refill per second and burst size
+THROTTLE_AD_RATE = float(os.getenv("THROTTLE_AD_RATE") or 0.5)
+THROTTLE_AD_BURST = float(os.getenv("THROTTLE_AD_BURST") or 3)
+THROTTLE_MENU_RATE = float(os.getenv("THROTTLE_MENU_RATE") or 1)
+THROTTLE_MENU_BURST = float(os.getenv("THROTTLE_MENU_BURST") or 5)
+THROTTLE_MAX_USERS = int(os.getenv("THROTTLE_MAX_USERS") or 50000)
+THROTTLE_IDLE_TTL = float(os.getenv("THROTTLE_IDLE_TTL") or 600)
+# Outbound notification queue: Telegram allows ~30 msg/s per bot and ~1 msg/s per chat
+NOTIFY_RATE = float(os.getenv("NOTIFY_RATE") or 25)
+NOTIFY_CHAT_INTERVAL = float(os.getenv("NOTIFY_CHAT_INTERVAL") or 1.0)
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS") or 4)
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES") or 5)
+# Admin broadcast: recipients fetched per batch, sends in flight, progress report period (s)
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH") or 500)
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY") or 8)
+BROADCAST_REPORT_INTERVAL = float(os.getenv("BROADCAST_REPORT_INTERVAL") or 15)
+# Withdraw-flow state (context.user_data) is flushed to Postgres this often (s)
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL") or 2)
+# Set to 1 when several instances serve the bot, so state is re-read per update
+STATE_SHARED = (os.getenv("STATE_SHARED") or "0") == "1"
+# Task rewards are buffered and applied to the ledger/balances in batches
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL") or 0.3)
+LEDGER_FLUSH_SIZE = int(os.getenv("LEDGER_FLUSH_SIZE") or 200)
+# /export keeps up to this many bytes of CSV in memory, then spills to a temp file
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE") or 1024 * 1024)
+# Threads that run blocking DB helpers off the event loop (defaults to the pool size)
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS") or DB_POOL_MAX)
+# Updates processed in parallel by the Application (one user's updates still run in order)
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES") or 64)
+
+# Webhook mode (used when WEBHOOK_URL is set, otherwise the bot polls)
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").rstrip("/")  # e.g. https://<app>.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH") or "/telegram"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or ""
+# Set to 0 to skip setWebhook, e.g. when POSTing recorded updates locally
+WEBHOOK_REGISTER = (os.getenv("WEBHOOK_REGISTER") or "1") != "0"
+HTTP_HOST = os.getenv("HTTP_HOST") or "0.0.0.0"
+PORT = int(os.getenv("PORT") or 8080)  # Render injects PORT for web services
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    # Without a secret anyone who knows the URL could post forged admin updates
+    if not WEBHOOK_REGISTER:
+        raise ValueError("WEBHOOK_SECRET must be set when WEBHOOK_REGISTER=0.")
+    # Registered with setWebhook below; set WEBHOOK_SECRET when several instances share the webhook
+    WEBHOOK_SECRET = secrets.token_urlsafe(32)
+
+# Prometheus metrics at GET /metrics, next to /healthz and /readyz (in polling
+# mode the HTTP server only starts when PORT is set)
+METRICS_ENABLED = (os.getenv("METRICS_ENABLED") or "1") != "0"
+# Seconds between latency summaries in the log; 0 disables
+METRICS_LOG_INTERVAL = int(os.getenv("METRICS_LOG_INTERVAL") or 0)
+
 # --- POSTGRES SETUP ---
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
@@ -58,11 +165,30 @@ try:
         'password': url.password,
         'host': url.hostname,
         'port': url.port,
-        'sslmode': 'require' # Neon and Render require SSL/TLS
+        'sslmode': os.getenv("DB_SSLMODE") or 'require', # Neon and Render require SSL/TLS
+        'connect_timeout': 10,
     }
 except Exception as e:
      raise ValueError(f"Invalid DATABASE_URL format: {e}")
 
+# Optional hot standby for read-only queries; same URL format, DB_SSLMODE applies too
+DATABASE_URL_REPLICA = os.getenv("DATABASE_URL_REPLICA") or ""
+REPLICA_PARAMS = None
+if DATABASE_URL_REPLICA:
+    try:
+        url = urlparse(DATABASE_URL_REPLICA)
+        REPLICA_PARAMS = dict(
+            DB_PARAMS,
+            database=url.path[1:],
+            user=url.username,
+            password=url.password,
+            host=url.hostname,
+            port=url.port,
+            connect_timeout=REPLICA_CONNECT_TIMEOUT,
+        )
+    except Exception as e:
+        raise ValueError(f"Invalid DATABASE_URL_REPLICA format: {e}")
+
 
 # Logging
 logging.basicConfig(
@@ -71,183 +197,2307 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-# --- DB CONNECTION & HELPERS ---
+# --- METRICS ---
+
+class Histogram:
+    """
+    Prometheus-style histogram keyed by label values. observe() is a bisect
+    plus a few increments under a lock, cheap enough for every update and
+    every query; it is safe to call from the DB executor threads.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {labels: list(series) for labels, series in self._series.items()}
+
+    def summarize(self):
+        """{label values: (count, avg, p95 bucket bound)} for the log summary."""
+        result = {}
+        for labels, series in self.snapshot().items():
+            counts, total = series[:-1], series[-1]
+            count = sum(counts)
+            running, p95 = 0, float("inf")
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                if running >= 0.95 * count:
+                    p95 = bound
+                    break
+            result[labels] = (count, total / count if count else 0.0, p95)
+        return result
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.snapshot().items()):
+            base = _format_labels(self.labels, labels)
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), series[:-1]):
+                running += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels + ('le',), labels + (le,))} {running}")
+            lines.append(f"{self.name}_sum{base} {series[-1]}")
+            lines.append(f"{self.name}_count{base} {running}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{_format_labels(self.labels, labels)} {value}" for labels, value in values)
+        return lines
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class MetricsRegistry:
+    """
+    Holds the process metrics and renders them in the Prometheus text format.
+    Besides histograms and counters, any component with a stats() dict (the
+    pool, cache, queues) is exported as gauges named bot_<component>_<key>.
+    """
+
+    def __init__(self, prefix="bot"):
+        self.prefix = prefix
+        self._metrics = []
+        self._stats_sources = {}
+
+    def histogram(self, name, help_text, labels=()):
+        metric = Histogram(f"{self.prefix}_{name}", help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        metric = Counter(f"{self.prefix}_{name}", help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def stats_source(self, component, stats):
+        self._stats_sources[component] = stats
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for component, stats in self._stats_sources.items():
+            try:
+                values = stats()
+            except Exception as e:
+                logger.warning("Metrics: %s stats unavailable: %s", component, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    lines.append(f"# TYPE {self.prefix}_{component}_{key} gauge")
+                    lines.append(f"{self.prefix}_{component}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+HANDLER_SECONDS = METRICS.histogram("handler_seconds", "Time spent in a Telegram handler.", ("handler", "branch"))
+HANDLER_ERRORS = METRICS.counter("handler_errors_total", "Handler calls that raised.", ("handler", "branch"))
+DB_HELPER_SECONDS = METRICS.histogram("db_helper_seconds", "Time spent in a DB helper.", ("helper",))
+DB_HELPER_ERRORS = METRICS.counter("db_helper_errors_total", "DB helper calls that raised.", ("helper",))
+DB_ACQUIRE_SECONDS = METRICS.histogram("db_pool_acquire_seconds", "Time to check out a pooled connection.")
+TELEGRAM_API_SECONDS = METRICS.histogram(
+    "telegram_api_seconds", "Bot API call duration.", ("method", "outcome")
+)
+
+# Component stats; the objects are looked up when /metrics is scraped
+METRICS.stats_source("db_pool", lambda: get_pool().stats())
+METRICS.stats_source("user_cache", lambda: USER_CACHE.stats())
+METRICS.stats_source("notify_queue", lambda: NOTIFIER.stats())
+METRICS.stats_source("conversation_state", lambda: CONVERSATION_STATE.stats())
+METRICS.stats_source("ledger", lambda: LEDGER.stats())
+METRICS.stats_source("throttle", lambda: THROTTLE.stats())
+METRICS.stats_source("db_replica", lambda: REPLICA.stats())
+
+# Branch label of the handler call in progress (see timed_handler)
+_handler_branch = contextvars.ContextVar("handler_branch", default=None)
+
+
+def set_branch(name):
+    """Labels the current handler call, e.g. set_branch("ad_finished")."""
+    _handler_branch.set(name)
+
+
+def timed_handler(func):
+    """Records the handler's latency (and failures) by handler name and branch."""
+    if not METRICS_ENABLED:
+        return func
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(update, context):
+        token = _handler_branch.set(None)
+        started = time.perf_counter()
+        try:
+            return await func(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name, _handler_branch.get() or "-")
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name, _handler_branch.get() or "-")
+            _handler_branch.reset(token)
+
+    return wrapper
+
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest that records every Bot API call by method and outcome."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method, outcome)
+
+
+async def metrics_endpoint(headers, body):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", METRICS.render().encode()
+
+
+async def log_metrics_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        for histogram in (HANDLER_SECONDS, DB_HELPER_SECONDS, DB_ACQUIRE_SECONDS, TELEGRAM_API_SECONDS):
+            for labels, (count, avg, p95) in sorted(histogram.summarize().items()):
+                series = f"[{'/'.join(labels)}]" if labels else ""
+                logger.info(
+                    "%s%s: n=%d avg=%.1fms p95<=%.0fms", histogram.name, series, count, avg * 1000, p95 * 1000
+                )
+
+
+# --- DB CONNECTION POOL ---
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers which statements it has PREPAREd."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+# A connection_factory set elsewhere (e.g. by a benchmark) should subclass
+# PreparingConnection, otherwise statements just run unprepared
+for _params in (DB_PARAMS, REPLICA_PARAMS):
+    if _params is not None:
+        _params.setdefault("connection_factory", PreparingConnection)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of persistent PostgreSQL connections.
+
+    Connections are opened lazily up to `maxconn`; callers beyond that wait
+    (up to `timeout` seconds) for one to be returned. Connections that sat idle
+    longer than `check_idle` seconds are pinged on checkout, and broken ones are
+    replaced transparently.
+    """
+
+    def __init__(self, params, minconn=1, maxconn=10, timeout=10.0, check_idle=30.0):
+        self._params = params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._cond = threading.Condition()
+        self._idle = collections.deque()  # (conn, returned_at)
+        self._size = 0  # open connections, idle + in use
+        self._in_use = 0
+        self._closed = False
+        # statistics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self._params)
+        except psycopg2.OperationalError as e:
+            logger.error(f"Database connection failed: {e}")
+            # সংযোগ ব্যর্থ হলে স্পষ্ট ত্রুটি দেখাবে
+            raise ConnectionError("Failed to connect to the external PostgreSQL database.")
+        self.created += 1
+        return conn
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.check_idle:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        self.discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """Checks out a healthy connection, waiting if the pool is exhausted."""
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise psycopg2.pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise psycopg2.pool.PoolError(
+                        f"no free database connection after {self.timeout:.1f}s"
+                    )
+                waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += time.monotonic() - started
+
+        try:
+            if conn is not None and not self._is_healthy(conn, returned_at):
+                logger.warning("Replacing broken pooled database connection.")
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        if METRICS_ENABLED:
+            DB_ACQUIRE_SECONDS.observe(time.monotonic() - started)
+        return conn
+
+    def putconn(self, conn, discard=False):
+        """Returns a connection; any open transaction is rolled back."""
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._cond:
+            self._in_use -= 1
+            if discard or conn.closed or self._closed:
+                self._size -= 1
+                self._close(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Context manager: `with pool.connection() as conn: ...`.
+        The connection always goes back to the pool; if the block fails with
+        OperationalError/InterfaceError the connection is dropped so the next
+        checkout reconnects.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, discard=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_time": round(self.wait_time, 3),
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "discarded": self.discarded,
+            }
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._close(conn)
+            self._cond.notify_all()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    DB_PARAMS,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    check_idle=DB_POOL_CHECK_IDLE,
+                )
+    return _pool
+
+
+def get_conn():
+    """
+    Borrows a pooled PostgreSQL connection.
+    Use as `with get_conn() as conn:`; the connection is returned (and any
+    uncommitted work rolled back) when the block exits.
+    """
+    return get_pool().connection()
+
+
+# Bounded executor for the synchronous psycopg2 helpers. Sized like the pool so
+# worker threads never queue up on connection checkout.
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+
+def db_helper(func):
+    """
+    Turns a blocking DB helper into a coroutine that runs on DB_EXECUTOR, so
+    handlers `await get_balance(tid)` without stalling the event loop.
+    The original function stays available as `helper.sync`.
+    """
+    name = func.__name__
+
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            DB_HELPER_ERRORS.inc(name)
+            raise
+        finally:
+            DB_HELPER_SECONDS.observe(time.perf_counter() - started, name)
+
+    call = timed if METRICS_ENABLED else func
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(DB_EXECUTOR, functools.partial(call, *args, **kwargs))
+
+    wrapper.sync = func
+    return wrapper
+
+
+async def log_stats_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("DB pool stats: %s", get_pool().stats())
+        logger.info("User cache stats: %s", USER_CACHE.stats())
+        logger.info("Notification queue stats: %s", NOTIFIER.stats())
+        logger.info("Conversation state stats: %s", CONVERSATION_STATE.stats())
+        logger.info("Ledger buffer stats: %s", LEDGER.stats())
+        logger.info("Throttle stats: %s", THROTTLE.stats())
+        if REPLICA.enabled:
+            logger.info("Read replica stats: %s", REPLICA.stats())
+
+
+# --- USER ROW CACHE ---
+
+class UserCache:
+    """
+    Size-bounded LRU cache of UserRecords keyed by telegram_id, with a TTL.
+
+    Writers call invalidate() after committing. A reader that missed takes a
+    token() before querying and passes it to put(); if the key was
+    invalidated in between, the (possibly stale) row is not cached.
+    """
+
+    def __init__(self, maxsize=10000, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rows = collections.OrderedDict()  # telegram_id -> (row, expires_at)
+        self._invalidated = collections.OrderedDict()  # telegram_id -> generation
+        self._generation = 0
+        self._forgotten_generation = 0  # newest generation dropped from _invalidated
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, telegram_id):
+        with self._lock:
+            entry = self._rows.get(telegram_id)
+            if entry is not None:
+                row, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._rows.move_to_end(telegram_id)
+                    self.hits += 1
+                    return row
+                del self._rows[telegram_id]
+            self.misses += 1
+            return None
+
+    def token(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, telegram_id, row, token):
+        with self._lock:
+            if token < self._forgotten_generation or self._invalidated.get(telegram_id, -1) > token:
+                return
+            self._rows[telegram_id] = (row, time.monotonic() + self.ttl)
+            self._rows.move_to_end(telegram_id)
+            while len(self._rows) > self.maxsize:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, *telegram_ids):
+        with self._lock:
+            for telegram_id in telegram_ids:
+                if telegram_id is None:
+                    continue
+                self._generation += 1
+                self.invalidations += 1
+                self._rows.pop(telegram_id, None)
+                self._invalidated[telegram_id] = self._generation
+                self._invalidated.move_to_end(telegram_id)
+                while len(self._invalidated) > self.maxsize:
+                    _, generation = self._invalidated.popitem(last=False)
+                    self._forgotten_generation = max(self._forgotten_generation, generation)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._rows),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+
+USER_CACHE = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+# --- READ REPLICA ---
+
+class ReplicaRouter:
+    """
+    Sends read-only queries to a second pool on DATABASE_URL_REPLICA, so the
+    dashboard, balances and admin reports don't compete with task crediting
+    on the primary. Reads still go to the primary when:
+
+    - their key (usually a telegram_id) was written less than
+      `read_your_writes` seconds ago, since the replica may not have replayed
+      that write yet; writers report keys through wrote();
+    - the replica is marked down: a failed connect or a dropped connection
+      marks it down for `retry_interval` seconds and closes its pool, and the
+      read that hit the failure is retried on the primary.
+
+    Without a replica configured every read goes to the primary.
+    """
+
+    def __init__(self, params, read_your_writes=5.0, retry_interval=30.0):
+        self._params = params
+        self.read_your_writes = read_your_writes
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._pool = None
+        self._down_until = 0.0
+        self._written = collections.OrderedDict()  # key -> monotonic time of its last write
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.failovers = 0
+
+    @property
+    def enabled(self):
+        return self._params is not None
+
+    def wrote(self, *keys):
+        """Keeps reads for `keys` on the primary for the next read_your_writes seconds."""
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                if key is None:
+                    continue
+                self._written[key] = now
+                self._written.move_to_end(key)
+            cutoff = now - self.read_your_writes
+            while self._written and next(iter(self._written.values())) <= cutoff:
+                self._written.popitem(last=False)
+
+    def _replica_pool(self, key):
+        """The replica pool if a read for `key` may use it, else None."""
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            if now < self._down_until:
+                return None
+            written_at = self._written.get(key)
+            if written_at is not None and now - written_at < self.read_your_writes:
+                return None
+            if self._pool is None:
+                self._pool = ConnectionPool(
+                    self._params,
+                    minconn=DB_POOL_MIN,
+                    maxconn=DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    check_idle=DB_POOL_CHECK_IDLE,
+                )
+            return self._pool
+
+    def _mark_down(self, pool, error):
+        with self._lock:
+            self.failovers += 1
+            if self._pool is not pool:
+                return  # another thread already did
+            self._pool = None
+            self._down_until = time.monotonic() + self.retry_interval
+        logger.warning("Read replica unavailable, using the primary for %.0fs: %s", self.retry_interval, error)
+        # Its other connections would fail the same way; in-use ones close on return
+        pool.closeall()
+
+    def read(self, query, key=None):
+        """
+        Returns query(conn), run on a replica connection when a read for `key`
+        may use one and on a primary connection otherwise. `query` must not
+        write: it may run on the replica and then again on the primary.
+        """
+        pool = self._replica_pool(key)
+        if pool is not None:
+            try:
+                with pool.connection() as conn:
+                    result = query(conn)
+            except (psycopg2.extensions.QueryCanceledError, psycopg2.extensions.TransactionRollbackError) as e:
+                # Cancelled by a recovery conflict or a timeout; the replica itself is fine
+                logger.warning("Replica read failed, retrying on the primary: %s", e)
+            except (ConnectionError, psycopg2.OperationalError, psycopg2.InterfaceError, psycopg2.pool.PoolError) as e:
+                self._mark_down(pool, e)
+            else:
+                with self._lock:
+                    self.replica_reads += 1
+                return result
+        with self._lock:
+            self.primary_reads += 1
+        with get_conn() as conn:
+            return query(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                # 0/1 rather than bools, which /metrics would render as True/False
+                "enabled": int(self.enabled),
+                "down": int(time.monotonic() < self._down_until),
+                "replica_reads": self.replica_reads,
+                "primary_reads": self.primary_reads,
+                "failovers": self.failovers,
+                "recent_writes": len(self._written),
+            }
+            pool = self._pool
+        if pool is not None:
+            stats.update({f"pool_{key}": value for key, value in pool.stats().items()})
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.closeall()
+
+
+REPLICA = ReplicaRouter(
+    REPLICA_PARAMS, read_your_writes=REPLICA_READ_YOUR_WRITES, retry_interval=REPLICA_RETRY_INTERVAL
+)
+
+
+def users_changed(*telegram_ids):
+    """
+    Call after committing a change to users' rows: drops their cached records
+    and keeps their reads on the primary until the replica has caught up.
+    """
+    USER_CACHE.invalidate(*telegram_ids)
+    REPLICA.wrote(*telegram_ids)
+
+
+# --- PER-USER THROTTLING ---
+
+class _ThrottleState:
+    __slots__ = ("last_seen", "limit_day", "buckets")
+
+    def __init__(self, now):
+        self.last_seen = now
+        self.limit_day = None  # date on which the user hit DAILY_TASK_LIMIT
+        self.buckets = {}  # kind -> [tokens, updated]
+
+
+class UserThrottle:
+    """
+    In-memory guard in front of the DB for button spam. Each user gets a
+    token bucket per kind ("ad", "menu"), and a flag remembering that today's
+    DAILY_TASK_LIMIT was reached, so further "I finished" taps are answered
+    without a query. The flag compares against today's date, so it lapses at
+    the daily boundary like tasks_done_date does.
+
+    Users idle for `idle_ttl` seconds are evicted and at most `maxsize` are
+    tracked. Only used from the event loop, so there is no locking.
+    """
+
+    def __init__(self, buckets, maxsize=50000, idle_ttl=600.0):
+        self.buckets = dict(buckets)  # kind -> (refill per second, burst); other kinds are not limited
+        self.maxsize = maxsize
+        self.idle_ttl = idle_ttl
+        self._users = collections.OrderedDict()  # telegram_id -> _ThrottleState, least recent first
+        self.rejected = collections.Counter()
+        self.evicted = 0
+
+    def _state(self, telegram_id, now):
+        state = self._users.get(telegram_id)
+        if state is None:
+            state = self._users[telegram_id] = _ThrottleState(now)
+        else:
+            self._users.move_to_end(telegram_id)
+            state.last_seen = now
+        while self._users:
+            oldest = next(iter(self._users.values()))
+            if len(self._users) <= self.maxsize and oldest.last_seen > now - self.idle_ttl:
+                break
+            self._users.popitem(last=False)
+            self.evicted += 1
+        return state
+
+    def allow(self, telegram_id, kind):
+        """Takes a token from the user's `kind` bucket; False means drop the request."""
+        if kind not in self.buckets:
+            return True
+        rate, burst = self.buckets[kind]
+        now = time.monotonic()
+        bucket = self._state(telegram_id, now).buckets.setdefault(kind, [burst, now])
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        self.rejected[kind] += 1
+        return False
+
+    def limit_reached(self, telegram_id):
+        state = self._users.get(telegram_id)
+        if state is not None and state.limit_day == datetime.date.today():
+            self.rejected["daily_limit"] += 1
+            return True
+        return False
+
+    def mark_limit_reached(self, telegram_id):
+        self._state(telegram_id, time.monotonic()).limit_day = datetime.date.today()
+
+    def stats(self):
+        stats = {"tracked": len(self._users), "evicted": self.evicted}
+        for kind in list(self.buckets) + ["daily_limit"]:
+            stats[f"rejected_{kind}"] = self.rejected[kind]
+        return stats
+
+
+THROTTLE = UserThrottle(
+    {"ad": (THROTTLE_AD_RATE, THROTTLE_AD_BURST), "menu": (THROTTLE_MENU_RATE, THROTTLE_MENU_BURST)},
+    maxsize=THROTTLE_MAX_USERS,
+    idle_ttl=THROTTLE_IDLE_TTL,
+)
+
+
+# --- UPDATE ORDERING ---
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different users concurrently (up to
+    max_concurrent_updates) but one user's updates one at a time, in the order
+    they arrived. Conversation state, the withdraw flow and the per-user
+    caches all assume a user's taps are handled in sequence; a plain
+    concurrent_updates(n) would let a fast double tap race itself.
+
+    Updates without a user (channel posts and the like) fall back to the
+    chat, and run unordered if they have neither.
+    """
+
+    __slots__ = ("_users",)
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._users = {}  # user or chat id -> [lock, updates holding or waiting for it]
+
+    @staticmethod
+    def _key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            await coroutine
+            return
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first come, first served
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# --- SCHEMA MIGRATIONS ---
+
+# (version, description, SQL). Append new steps; never edit applied ones.
+SCHEMA_MIGRATIONS = [
+    (1, "create users and withdrawals tables", """
+        -- users table
+        CREATE TABLE IF NOT EXISTS users (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE NOT NULL,
+            first_name TEXT,
+            username TEXT,
+            balance BIGINT DEFAULT 0, 
+            bonus_given INTEGER DEFAULT 0,
+            referred_by BIGINT DEFAULT NULL,
+            referrals_count INTEGER DEFAULT 0,
+            tasks_done_date TEXT DEFAULT NULL,
+            tasks_done_count INTEGER DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        
+        -- withdrawals table
+        CREATE TABLE IF NOT EXISTS withdrawals (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT,
+            method TEXT,
+            account TEXT,
+            amount BIGINT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            processed_at TIMESTAMP WITH TIME ZONE DEFAULT NULL
+        );
+    """),
+    (2, "partial index on pending withdrawals by created_at", """
+        CREATE INDEX IF NOT EXISTS withdrawals_pending_created_idx
+            ON withdrawals (created_at, id) WHERE status = 'pending';
+    """),
+    (3, "index withdrawals.telegram_id and users.referred_by", """
+        CREATE INDEX IF NOT EXISTS withdrawals_telegram_id_idx ON withdrawals (telegram_id);
+        CREATE INDEX IF NOT EXISTS users_referred_by_idx ON users (referred_by);
+    """),
+    (4, "store users.tasks_done_date as DATE", """
+        ALTER TABLE users
+            ALTER COLUMN tasks_done_date TYPE DATE USING NULLIF(tasks_done_date, '')::date;
+    """),
+    (5, "broadcasts table for resumable admin broadcasts", """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_telegram_id BIGINT NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            finished_at TIMESTAMP WITH TIME ZONE DEFAULT NULL
+        );
+    """),
+    (6, "conversation_state table for persisted user_data", """
+        CREATE TABLE IF NOT EXISTS conversation_state (
+            telegram_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+    """),
+    (7, "append-only balance ledger, opened with current balances", """
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            amount BIGINT NOT NULL,
+            reason TEXT NOT NULL,
+            ref_id BIGINT DEFAULT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS balance_ledger_telegram_id_idx ON balance_ledger (telegram_id);
+        INSERT INTO balance_ledger (telegram_id, amount, reason)
+            SELECT telegram_id, balance, 'opening' FROM users WHERE balance <> 0;
+    """),
+    (8, "admin_stats summary kept current by statement triggers", """
+        -- One row per shard; a backend only touches the row for its pid, so
+        -- concurrent writers don't queue on a single hot row. /stats sums them.
+        CREATE TABLE IF NOT EXISTS admin_stats (
+            shard SMALLINT PRIMARY KEY,
+            users_total BIGINT NOT NULL DEFAULT 0,
+            balance_total BIGINT NOT NULL DEFAULT 0,
+            pending_count BIGINT NOT NULL DEFAULT 0,
+            pending_amount BIGINT NOT NULL DEFAULT 0,
+            day DATE NOT NULL DEFAULT CURRENT_DATE,
+            signups_today BIGINT NOT NULL DEFAULT 0,
+            tasks_today BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO admin_stats (shard) SELECT generate_series(0, 31) ON CONFLICT DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION admin_stats_add(d_users BIGINT, d_balance BIGINT, d_pending_count BIGINT,
+                                                   d_pending_amount BIGINT, d_signups BIGINT, d_tasks BIGINT)
+        RETURNS void LANGUAGE sql AS $$
+            UPDATE admin_stats SET
+                users_total = users_total + d_users,
+                balance_total = balance_total + d_balance,
+                pending_count = pending_count + d_pending_count,
+                pending_amount = pending_amount + d_pending_amount,
+                signups_today = CASE WHEN day = CURRENT_DATE THEN signups_today ELSE 0 END + d_signups,
+                tasks_today = CASE WHEN day = CURRENT_DATE THEN tasks_today ELSE 0 END + d_tasks,
+                day = CURRENT_DATE
+            WHERE shard = mod(pg_backend_pid(), 32);
+        $$;
+
+        -- Statement-level with transition tables: a batched write (ledger
+        -- flush, bulk approve) costs one summary update, not one per row.
+        CREATE OR REPLACE FUNCTION admin_stats_users() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            d_users BIGINT;
+            d_signups BIGINT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT COUNT(*), COUNT(*) INTO d_users, d_signups FROM new_rows;
+            ELSE
+                SELECT -COUNT(*), -COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE)
+                INTO d_users, d_signups FROM old_rows;
+            END IF;
+            IF d_users <> 0 THEN
+                PERFORM admin_stats_add(d_users, 0, 0, 0, d_signups, 0);
+            END IF;
+            RETURN NULL;
+        END $$;
+
+        -- Every balance change is a ledger entry (see migration 7), so the
+        -- liability and today's finished tasks follow balance_ledger.
+        CREATE OR REPLACE FUNCTION admin_stats_ledger() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            d_balance BIGINT;
+            d_tasks BIGINT;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT COALESCE(SUM(amount), 0), COUNT(*) FILTER (WHERE reason = 'task_reward')
+                INTO d_balance, d_tasks FROM new_rows;
+            ELSE
+                SELECT -COALESCE(SUM(amount), 0),
+                       -COUNT(*) FILTER (WHERE reason = 'task_reward' AND created_at >= CURRENT_DATE)
+                INTO d_balance, d_tasks FROM old_rows;
+            END IF;
+            IF d_balance <> 0 OR d_tasks <> 0 THEN
+                PERFORM admin_stats_add(0, d_balance, 0, 0, 0, d_tasks);
+            END IF;
+            RETURN NULL;
+        END $$;
+
+        CREATE OR REPLACE FUNCTION admin_stats_withdrawals() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            d_count BIGINT := 0;
+            d_amount BIGINT := 0;
+            o_count BIGINT := 0;
+            o_amount BIGINT := 0;
+        BEGIN
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                SELECT COUNT(*), COALESCE(SUM(amount), 0) INTO d_count, d_amount
+                FROM new_rows WHERE status = 'pending';
+            END IF;
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                SELECT COUNT(*), COALESCE(SUM(amount), 0) INTO o_count, o_amount
+                FROM old_rows WHERE status = 'pending';
+            END IF;
+            IF d_count <> o_count OR d_amount <> o_amount THEN
+                PERFORM admin_stats_add(0, 0, d_count - o_count, d_amount - o_amount, 0, 0);
+            END IF;
+            RETURN NULL;
+        END $$;
+
+        DROP TRIGGER IF EXISTS admin_stats_users_ins ON users;
+        DROP TRIGGER IF EXISTS admin_stats_users_del ON users;
+        CREATE TRIGGER admin_stats_users_ins AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_users();
+        CREATE TRIGGER admin_stats_users_del AFTER DELETE ON users
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_users();
+
+        DROP TRIGGER IF EXISTS admin_stats_ledger_ins ON balance_ledger;
+        DROP TRIGGER IF EXISTS admin_stats_ledger_del ON balance_ledger;
+        CREATE TRIGGER admin_stats_ledger_ins AFTER INSERT ON balance_ledger
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_ledger();
+        CREATE TRIGGER admin_stats_ledger_del AFTER DELETE ON balance_ledger
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_ledger();
+
+        DROP TRIGGER IF EXISTS admin_stats_withdrawals_ins ON withdrawals;
+        DROP TRIGGER IF EXISTS admin_stats_withdrawals_upd ON withdrawals;
+        DROP TRIGGER IF EXISTS admin_stats_withdrawals_del ON withdrawals;
+        CREATE TRIGGER admin_stats_withdrawals_ins AFTER INSERT ON withdrawals
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_withdrawals();
+        CREATE TRIGGER admin_stats_withdrawals_upd AFTER UPDATE ON withdrawals
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_withdrawals();
+        CREATE TRIGGER admin_stats_withdrawals_del AFTER DELETE ON withdrawals
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION admin_stats_withdrawals();
+
+        -- Recomputes everything from the base tables (/stats rebuild). The lock
+        -- waits for in-flight writers and holds new ones back until we commit.
+        CREATE OR REPLACE FUNCTION admin_stats_rebuild() RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            LOCK TABLE admin_stats IN EXCLUSIVE MODE;
+            UPDATE admin_stats SET users_total = 0, balance_total = 0, pending_count = 0, pending_amount = 0,
+                day = CURRENT_DATE, signups_today = 0, tasks_today = 0;
+            UPDATE admin_stats s SET
+                users_total = u.n, signups_today = u.signups, balance_total = l.balance, tasks_today = l.tasks,
+                pending_count = w.n, pending_amount = w.amount
+            FROM (
+                SELECT COUNT(*) AS n, COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS signups FROM users
+            ) u, (
+                SELECT COALESCE(SUM(amount), 0) AS balance,
+                       COUNT(*) FILTER (WHERE reason = 'task_reward' AND created_at >= CURRENT_DATE) AS tasks
+                FROM balance_ledger
+            ) l, (
+                SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0) AS amount FROM withdrawals WHERE status = 'pending'
+            ) w
+            WHERE s.shard = 0;
+        END $$;
+        SELECT admin_stats_rebuild();
+    """),
+    (9, "idempotency key on withdrawals", """
+        ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+        CREATE UNIQUE INDEX IF NOT EXISTS withdrawals_idempotency_key_idx ON withdrawals (idempotency_key);
+    """),
+    (10, "rebuild admin_stats without locking out writers", """
+        -- The base tables and admin_stats are read in one statement, so one
+        -- snapshot: their difference is the drift, and a writer committing
+        -- after it moves both sides equally. The scans take no lock; adding the
+        -- drift to shard 0 only holds that row until commit.
+        CREATE OR REPLACE FUNCTION admin_stats_rebuild() RETURNS void LANGUAGE plpgsql AS $$
+        DECLARE
+            d RECORD;
+        BEGIN
+            SELECT u.n - s.users AS users, l.balance - s.balance AS balance,
+                   w.n - s.pending_count AS pending_count, w.amount - s.pending_amount AS pending_amount,
+                   u.signups - s.signups AS signups, l.tasks - s.tasks AS tasks
+            INTO d
+            FROM (
+                SELECT COUNT(*) AS n, COUNT(*) FILTER (WHERE created_at >= CURRENT_DATE) AS signups FROM users
+            ) u, (
+                SELECT COALESCE(SUM(amount), 0) AS balance,
+                       COUNT(*) FILTER (WHERE reason = 'task_reward' AND created_at >= CURRENT_DATE) AS tasks
+                FROM balance_ledger
+            ) l, (
+                SELECT COUNT(*) AS n, COALESCE(SUM(amount), 0) AS amount FROM withdrawals WHERE status = 'pending'
+            ) w, (
+                SELECT COALESCE(SUM(users_total), 0) AS users, COALESCE(SUM(balance_total), 0) AS balance,
+                       COALESCE(SUM(pending_count), 0) AS pending_count,
+                       COALESCE(SUM(pending_amount), 0) AS pending_amount,
+                       COALESCE(SUM(signups_today) FILTER (WHERE day = CURRENT_DATE), 0) AS signups,
+                       COALESCE(SUM(tasks_today) FILTER (WHERE day = CURRENT_DATE), 0) AS tasks
+                FROM admin_stats
+            ) s;
+            UPDATE admin_stats SET
+                users_total = users_total + d.users,
+                balance_total = balance_total + d.balance,
+                pending_count = pending_count + d.pending_count,
+                pending_amount = pending_amount + d.pending_amount,
+                signups_today = CASE WHEN day = CURRENT_DATE THEN signups_today ELSE 0 END + d.signups,
+                tasks_today = CASE WHEN day = CURRENT_DATE THEN tasks_today ELSE 0 END + d.tasks,
+                day = CURRENT_DATE
+            WHERE shard = 0;
+        END $$;
+    """),
+]
+
+# Arbitrary key for pg_advisory_lock so two booting instances don't migrate at once
+MIGRATION_LOCK_KEY = 727100
+
+
+def migrate(dry_run=False):
+    """
+    Applies pending SCHEMA_MIGRATIONS in order, each in its own transaction,
+    and records them in schema_version. With dry_run=True nothing is changed;
+    the pending steps are only returned.
+    Returns the list of (version, description) that are/were pending.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        has_version_table = cur.fetchone()[0]
+        if dry_run:
+            applied = set()
+            if has_version_table:
+                cur.execute("SELECT version FROM schema_version")
+                applied = {r[0] for r in cur.fetchall()}
+            return [(v, d) for v, d, _ in SCHEMA_MIGRATIONS if v not in applied]
+
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+        try:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+                )
+            """)
+            cur.execute("SELECT version FROM schema_version")
+            applied = {r[0] for r in cur.fetchall()}
+            conn.commit()
+
+            pending = []
+            for version, description, sql in SCHEMA_MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info("Applying schema migration %s: %s", version, description)
+                cur.execute(sql)
+                cur.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (version, description),
+                )
+                conn.commit()
+                pending.append((version, description))
+            return pending
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+
+
+def schema_is_current():
+    """True when every SCHEMA_MIGRATIONS version is recorded; one read-only query."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT COUNT(*) FROM schema_version WHERE version = ANY(%s)",
+                ([version for version, _, _ in SCHEMA_MIGRATIONS],),
+            )
+        except psycopg2.errors.UndefinedTable:
+            return False
+        current = cur.fetchone()[0] == len(SCHEMA_MIGRATIONS)
+        conn.commit()
+        return current
+
+
+def init_db():
+    """Brings the schema up to date (see SCHEMA_MIGRATIONS); skips DDL when it already is."""
+    if schema_is_current():
+        return
+    applied = migrate()
+    if applied:
+        logger.info("Applied %d schema migration(s).", len(applied))
+
+
+# --- TYPED RECORDS AND PREPARED STATEMENTS ---
+
+class UserRecord:
+    """The users columns the handlers read, fetched as UserRecord.COLUMNS."""
+
+    __slots__ = ("telegram_id", "first_name", "balance", "referrals_count", "tasks_done_date", "tasks_done_count")
+    COLUMNS = ", ".join(__slots__)
+
+    def __init__(self, telegram_id, first_name, balance, referrals_count, tasks_done_date, tasks_done_count):
+        self.telegram_id = telegram_id
+        self.first_name = first_name
+        self.balance = balance or 0
+        self.referrals_count = referrals_count or 0
+        self.tasks_done_date = tasks_done_date
+        self.tasks_done_count = tasks_done_count or 0
+
+    @property
+    def tasks_today(self):
+        """tasks_done_count only counts for tasks_done_date; any other day it is 0."""
+        return self.tasks_done_count if self.tasks_done_date == datetime.date.today() else 0
+
+    def __repr__(self):
+        return f"UserRecord(telegram_id={self.telegram_id}, balance={self.balance})"
+
+
+class WithdrawalRecord:
+    """One withdrawals row as shown to the admin, fetched as WithdrawalRecord.COLUMNS."""
+
+    __slots__ = ("id", "telegram_id", "method", "account", "amount", "status", "created_at")
+    COLUMNS = ", ".join(__slots__)
+
+    def __init__(self, id, telegram_id, method, account, amount, status, created_at):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.method = method
+        self.account = account
+        self.amount = amount
+        self.status = status
+        self.created_at = created_at
+
+    def __repr__(self):
+        return f"WithdrawalRecord(id={self.id}, telegram_id={self.telegram_id}, amount={self.amount}, status={self.status!r})"
+
+
+class PreparedStatement:
+    """
+    A hot query run as a named server-side prepared statement: PREPAREd the
+    first time it is used on a connection, then only EXECUTEd, so Postgres
+    parses and plans it once per connection rather than on every call.
+    `sql` uses $1, $2... placeholders. Prepared statements outlive rolled-back
+    transactions and go away with the connection, which is exactly what
+    PreparingConnection.prepared tracks. With DB_PREPARED_STATEMENTS=0, or on
+    a connection that isn't a PreparingConnection, it runs as a plain query.
+    """
+
+    def __init__(self, name, sql):
+        self.name = name
+        self.sql = sql
+        numbers = [int(n) for n in re.findall(r"\$(\d+)", sql)]
+        self._plain_sql = re.sub(r"\$\d+", "%s", sql)
+        self._plain_order = [n - 1 for n in numbers]
+        placeholders = ", ".join(["%s"] * max(numbers, default=0))
+        self._execute_sql = f"EXECUTE {name} ({placeholders})" if placeholders else f"EXECUTE {name}"
+
+    def execute(self, cur, params=()):
+        """Runs the statement on `cur` and returns the cursor for fetching."""
+        prepared = getattr(cur.connection, "prepared", None)
+        if not DB_PREPARED_STATEMENTS or prepared is None:
+            cur.execute(self._plain_sql, [params[i] for i in self._plain_order])
+            return cur
+        idle = cur.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        try:
+            if self.name not in prepared:
+                # On its own, so a failed EXECUTE never leaves us unsure whether this ran
+                cur.execute(f"PREPARE {self.name} AS {self.sql}")
+                prepared.add(self.name)
+            cur.execute(self._execute_sql, params)
+        except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement) as e:
+            # The server's statements no longer match our set (DISCARD ALL, a
+            # transaction-mode pooler in between): forget it and run it plain. Only
+            # safe to retry if nothing else ran in the transaction we just aborted.
+            prepared.discard(self.name)
+            if not idle:
+                raise
+            logger.warning("Prepared statement %s out of sync (%s), running it plain", self.name, e.pgcode)
+            cur.connection.rollback()
+            cur.execute(self._plain_sql, [params[i] for i in self._plain_order])
+        return cur
+
+
+# --- DB HELPERS ---
+
+USER_BY_ID = PreparedStatement("user_by_id", f"SELECT {UserRecord.COLUMNS} FROM users WHERE telegram_id = $1")
+
+
+@db_helper
+def get_user(telegram_id):
+    """The user's UserRecord, or None if they never pressed /start."""
+    user = USER_CACHE.get(telegram_id)
+    if user is not None:
+        return user
+    token = USER_CACHE.token()
+    row = REPLICA.read(lambda conn: USER_BY_ID.execute(conn.cursor(), (telegram_id,)).fetchone(), telegram_id)
+    if row is None:
+        return None
+    user = UserRecord(*row)
+    USER_CACHE.put(telegram_id, user, token)
+    return user
+
+
+@db_helper
+def register_user(telegram_id, first_name="", username="", referred_by=None, bonus=SIGNUP_BONUS):
+    """
+    /start registration in one round-trip: inserts the user with the signup
+    bonus already applied (or applies it to an existing user who never got
+    it) and, for a brand-new user, credits the referrer in the same statement.
+    Both credits are written to balance_ledger by the same statement.
+    Returns (is_new, bonus_given, referrer_credited).
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        # xmax = 0 only for freshly inserted rows, not ON CONFLICT updates
+        cur.execute(
+            """
+            WITH upsert AS (
+                INSERT INTO users (telegram_id, first_name, username, referred_by, balance, bonus_given)
+                VALUES (%(tid)s, %(first_name)s, %(username)s, %(referred_by)s, %(bonus)s, 1)
+                ON CONFLICT (telegram_id) DO UPDATE
+                    SET balance = users.balance + EXCLUDED.balance, bonus_given = 1
+                    WHERE users.bonus_given = 0
+                RETURNING (xmax = 0) AS inserted
+            ), referrer AS (
+                UPDATE users
+                SET referrals_count = referrals_count + 1, balance = balance + %(ref_bonus)s
+                WHERE telegram_id = %(referred_by)s AND telegram_id <> %(tid)s
+                  AND EXISTS (SELECT 1 FROM upsert WHERE inserted)
+                RETURNING telegram_id
+            ), bonus_entry AS (
+                INSERT INTO balance_ledger (telegram_id, amount, reason)
+                SELECT %(tid)s, %(bonus)s, 'signup_bonus' FROM upsert
+            ), referral_entry AS (
+                INSERT INTO balance_ledger (telegram_id, amount, reason, ref_id)
+                SELECT telegram_id, %(ref_bonus)s, 'referral_bonus', %(tid)s FROM referrer
+            )
+            SELECT COALESCE((SELECT inserted FROM upsert), FALSE),
+                   EXISTS (SELECT 1 FROM upsert),
+                   EXISTS (SELECT 1 FROM referrer)
+            """,
+            {
+                "tid": telegram_id,
+                "first_name": first_name,
+                "username": username,
+                "referred_by": referred_by,
+                "bonus": bonus,
+                "ref_bonus": REF_BONUS,
+            },
+        )
+        row = cur.fetchone()
+        conn.commit()
+    users_changed(telegram_id, referred_by)
+    return row
+
+
+BALANCE_BY_ID = PreparedStatement("balance_by_id", "SELECT balance FROM users WHERE telegram_id = $1")
+
+
+@db_helper
+def get_balance(telegram_id):
+    row = REPLICA.read(lambda conn: BALANCE_BY_ID.execute(conn.cursor(), (telegram_id,)).fetchone(), telegram_id)
+    return row[0] if row else 0
+
+
+CREDIT_TASK = PreparedStatement("credit_task", """
+    WITH credited AS (
+        UPDATE users
+        SET tasks_done_count = CASE WHEN tasks_done_date = $2 THEN tasks_done_count + 1 ELSE 1 END,
+            tasks_done_date = $2
+        WHERE telegram_id = $1
+          AND (tasks_done_date IS DISTINCT FROM $2 OR tasks_done_count < $3)
+        RETURNING tasks_done_count, balance
+    )
+    SELECT tasks_done_count, balance, TRUE FROM credited
+    UNION ALL
+    SELECT tasks_done_count, balance, FALSE FROM users
+    WHERE telegram_id = $1 AND NOT EXISTS (SELECT 1 FROM credited)
+""")
+
+
+@db_helper
+def credit_task(telegram_id):
+    """
+    Records one finished task in a single statement: the daily reset,
+    DAILY_TASK_LIMIT check and counter increment happen in one conditional
+    UPDATE, so concurrent taps cannot exceed the limit. The reward itself is
+    queued on LEDGER by the caller. Returns (tasks_done_count, balance,
+    credited), where balance does not yet include buffered rewards.
+    """
+    today = datetime.date.today()
+    with get_conn() as conn:
+        row = CREDIT_TASK.execute(conn.cursor(), (telegram_id, today, DAILY_TASK_LIMIT)).fetchone()
+        conn.commit()
+    if not row:
+        return (0, 0, False)
+    if row[2]:
+        users_changed(telegram_id)
+    return row
+
+
+@db_helper
+def reconcile_balances(limit=50):
+    """
+    Compares users.balance with the sum of each user's ledger entries.
+    Returns (mismatch_count, [(telegram_id, balance, ledger_total), ...]).
+    """
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT COALESCE(u.telegram_id, l.telegram_id), COALESCE(u.balance, 0), COALESCE(l.total, 0)
+            FROM users u
+            FULL JOIN (
+                SELECT telegram_id, SUM(amount) AS total FROM balance_ledger GROUP BY telegram_id
+            ) l ON l.telegram_id = u.telegram_id
+            WHERE COALESCE(u.balance, 0) <> COALESCE(l.total, 0)
+            ORDER BY 1
+            """
+        )
+        return cur.fetchall()
+
+    rows = REPLICA.read(query, ADMIN_ID)
+    return len(rows), rows[:limit]
+
+
+@db_helper
+def submit_withdrawal(telegram_id, method, account, amount, idempotency_key):
+    """
+    Debits the balance, creates the withdrawal and its ledger entry in one
+    statement. The debit is conditional (balance >= amount), so concurrent
+    submits cannot overdraw, and the user row is locked only for that
+    statement. A request with an already used idempotency_key creates
+    nothing. Returns (status, withdraw_id) with status "created",
+    "duplicate" (id of the earlier request) or "insufficient" (id None).
+    """
+    params = {"tid": telegram_id, "method": method, "account": account, "amount": amount, "key": idempotency_key}
+    with get_conn() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                WITH debited AS (
+                    UPDATE users SET balance = balance - %(amount)s
+                    WHERE telegram_id = %(tid)s AND balance >= %(amount)s
+                      AND NOT EXISTS (SELECT 1 FROM withdrawals WHERE idempotency_key = %(key)s)
+                    RETURNING telegram_id
+                ), request AS (
+                    INSERT INTO withdrawals (telegram_id, method, account, amount, idempotency_key)
+                    SELECT telegram_id, %(method)s, %(account)s, %(amount)s, %(key)s FROM debited
+                    RETURNING id
+                ), entry AS (
+                    INSERT INTO balance_ledger (telegram_id, amount, reason, ref_id)
+                    SELECT %(tid)s, -%(amount)s, 'withdrawal', id FROM request
+                )
+                SELECT id, 'created' FROM request
+                UNION ALL
+                SELECT id, 'duplicate' FROM withdrawals
+                WHERE idempotency_key = %(key)s AND NOT EXISTS (SELECT 1 FROM request)
+                """,
+                params,
+            )
+            row = cur.fetchone()
+            conn.commit()
+        except psycopg2.errors.UniqueViolation:
+            # A concurrent submit with the same key committed first; ours rolled back entirely
+            conn.rollback()
+            cur.execute("SELECT id, 'duplicate' FROM withdrawals WHERE idempotency_key = %(key)s", params)
+            row = cur.fetchone()
+            conn.commit()
+    if not row:
+        return "insufficient", None
+    if row[1] == "created":
+        users_changed(telegram_id)
+    return row[1], row[0]
+
+
+@db_helper
+def process_withdrawals(status, ids=None, newest=None, oldest=None):
+    """
+    Moves pending withdrawals to `status` ("approved" or "rejected") in one
+    set-based statement; rejected ones are refunded to their users in the
+    same transaction. Select either by `ids` or by the (created_at, id) range
+    `oldest`..`newest` (either end may be None). Requests that are no longer
+    pending are skipped, so a double tap can't refund twice.
+    Returns the processed rows as (id, telegram_id, amount).
+    """
+    conditions = ["status = 'pending'"]
+    params = {"status": status, "refund": status == "rejected"}
+    if ids is not None:
+        conditions.append("id = ANY(%(ids)s)")
+        params["ids"] = list(ids)
+    if newest is not None:
+        conditions.append("(created_at, id) <= (%(newest_at)s, %(newest_id)s)")
+        params["newest_at"], params["newest_id"] = newest
+    if oldest is not None:
+        conditions.append("(created_at, id) >= (%(oldest_at)s, %(oldest_id)s)")
+        params["oldest_at"], params["oldest_id"] = oldest
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            WITH done AS (
+                UPDATE withdrawals SET status = %(status)s, processed_at = NOW()
+                WHERE {' AND '.join(conditions)}
+                RETURNING id, telegram_id, amount
+            ), refunds AS (
+                UPDATE users u SET balance = u.balance + r.total
+                FROM (SELECT telegram_id, SUM(amount) AS total FROM done GROUP BY telegram_id) r
+                WHERE %(refund)s AND u.telegram_id = r.telegram_id
+                RETURNING u.telegram_id
+            ), refund_entries AS (
+                INSERT INTO balance_ledger (telegram_id, amount, reason, ref_id)
+                SELECT telegram_id, amount, 'refund', id FROM done
+                WHERE telegram_id IN (SELECT telegram_id FROM refunds)
+            )
+            SELECT id, telegram_id, amount FROM done ORDER BY id
+            """,
+            params,
+        )
+        rows = cur.fetchall()
+        conn.commit()
+    if status == "rejected":
+        users_changed(*{r[1] for r in rows})
+    # The admin's next /withdraws page and /stats must not list these as pending
+    REPLICA.wrote(ADMIN_ID)
+    return rows
+
+
+@db_helper
+def get_pending_withdraws_summary():
+    """Returns (count, total_amount, newest_cursor) for pending withdrawals."""
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM withdrawals WHERE status = 'pending'")
+        count, total = cur.fetchone()
+        cur.execute(
+            "SELECT created_at, id FROM withdrawals WHERE status = 'pending' ORDER BY created_at DESC, id DESC LIMIT 1"
+        )
+        return count, total, cur.fetchone()
+
+    return REPLICA.read(query, ADMIN_ID)
+
+
+@db_helper
+def get_pending_withdraws_page(cursor=None, direction="older", limit=WITHDRAW_PAGE_SIZE):
+    """
+    One page of pending withdrawals, newest first, by keyset pagination on
+    (created_at, id) so every page is a single scan of the partial index.
+
+    cursor is a (created_at, id) pair; direction is "older" (rows after the
+    cursor), "newer" (rows before it) or "from" (the cursor row onwards).
+    Returns (records, has_more, has_back): has_more means another page exists
+    in that direction, has_back that pending rows exist on the other side of
+    the page (looked up, since they may have been processed meanwhile).
+    """
+    params = {"limit": limit + 1}
+    if cursor is None:
+        where, order = "", "DESC"
+    else:
+        params["created_at"], params["id"] = cursor
+        where, order = {
+            "older": ("AND (created_at, id) < (%(created_at)s, %(id)s)", "DESC"),
+            "from": ("AND (created_at, id) <= (%(created_at)s, %(id)s)", "DESC"),
+            "newer": ("AND (created_at, id) > (%(created_at)s, %(id)s)", "ASC"),
+        }[direction]
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {WithdrawalRecord.COLUMNS}
+            FROM withdrawals
+            WHERE status = 'pending' {where}
+            ORDER BY created_at {order}, id {order}
+            LIMIT %(limit)s
+            """,
+            params,
+        )
+        rows = [WithdrawalRecord(*row) for row in cur.fetchall()]
+        if cursor is None or not rows:
+            return rows, False
+        # The page starts at rows[0] in the query's order; look one row back from it
+        cur.execute(
+            f"""
+            SELECT EXISTS (
+                SELECT 1 FROM withdrawals
+                WHERE status = 'pending' AND (created_at, id) {">" if order == "DESC" else "<"} (%s, %s)
+            )
+            """,
+            (rows[0].created_at, rows[0].id),
+        )
+        return rows, cur.fetchone()[0]
+
+    rows, has_back = REPLICA.read(query, ADMIN_ID)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "ASC":
+        rows.reverse()
+    return rows, has_more, has_back
+
+
+@db_helper
+def get_admin_stats(rebuild=False):
+    """
+    Reads the admin_stats summary (kept current by triggers, see migration 8).
+    Returns a dict; with rebuild=True the summary is first corrected against
+    the base tables, which scans users, balance_ledger and withdrawals.
+    """
+    def query(conn):
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(users_total), 0)::bigint, COALESCE(SUM(balance_total), 0)::bigint,
+                   COALESCE(SUM(pending_count), 0)::bigint, COALESCE(SUM(pending_amount), 0)::bigint,
+                   COALESCE(SUM(signups_today) FILTER (WHERE day = CURRENT_DATE), 0)::bigint,
+                   COALESCE(SUM(tasks_today) FILTER (WHERE day = CURRENT_DATE), 0)::bigint
+            FROM admin_stats
+            """
+        )
+        return cur.fetchone()
+
+    if rebuild:
+        with get_conn() as conn:
+            conn.cursor().execute("SELECT admin_stats_rebuild()")
+            row = query(conn)
+            conn.commit()
+        REPLICA.wrote(ADMIN_ID)
+    else:
+        row = REPLICA.read(query, ADMIN_ID)
+    keys = ("users", "balance", "pending_count", "pending_amount", "signups_today", "tasks_today")
+    return dict(zip(keys, row))
+
+
+EXPORT_QUERIES = {
+    "withdrawals": """
+        SELECT id, telegram_id, amount, method, account, status, created_at, processed_at
+        FROM withdrawals WHERE {where} ORDER BY created_at, id
+    """,
+    "users": """
+        SELECT telegram_id, first_name, username, balance, referred_by, referrals_count,
+               tasks_done_date, tasks_done_count, created_at
+        FROM users WHERE {where} ORDER BY telegram_id
+    """,
+}
+
+
+@db_helper
+def export_csv(kind, status=None, since=None, until=None):
+    """
+    Streams `kind` ("withdrawals" or "users") as CSV through COPY ... TO
+    STDOUT into a SpooledTemporaryFile, so memory use stays at
+    EXPORT_SPOOL_SIZE however many rows there are. `since`/`until` are
+    inclusive dates on created_at; `status` only applies to withdrawals.
+    The read-only transaction takes no lock that handlers' writes wait for.
+    Returns (file rewound to the start, size in bytes); the caller closes it.
+    """
+    conditions, params = ["TRUE"], []
+    if status and kind == "withdrawals":
+        conditions.append("status = %s")
+        params.append(status)
+    if since:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until:
+        conditions.append("created_at < %s")
+        params.append(until + datetime.timedelta(days=1))
+
+    def query(conn):
+        # Start over if a replica failed part-way and this is the retry on the primary
+        out.seek(0)
+        out.truncate()
+        cur = conn.cursor()
+        cur.execute("SET TRANSACTION READ ONLY")
+        select = cur.mogrify(EXPORT_QUERIES[kind].format(where=" AND ".join(conditions)), params).decode()
+        cur.copy_expert(f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)", out)
+        conn.commit()
+
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+    try:
+        REPLICA.read(query, ADMIN_ID)
+        size = out.tell()
+        out.seek(0)
+    except BaseException:
+        out.close()
+        raise
+    return out, size
+
+
+# --- BALANCE LEDGER (task rewards, write-behind) ---
+
+def _apply_ledger_entries(entries):
+    """Inserts ledger entries and adds their sums to users.balance in one statement."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            WITH entries AS (
+                INSERT INTO balance_ledger (telegram_id, amount, reason, ref_id) VALUES %s
+                RETURNING telegram_id, amount
+            )
+            UPDATE users u SET balance = u.balance + e.total
+            FROM (SELECT telegram_id, SUM(amount) AS total FROM entries GROUP BY telegram_id) e
+            WHERE u.telegram_id = e.telegram_id
+            """,
+            entries,
+            page_size=len(entries),
+        )
+        conn.commit()
+
+
+class LedgerBuffer:
+    """
+    In-memory buffer of task-reward ledger entries. Entries are applied
+    every `interval` seconds, or as soon as `max_entries` are waiting, as one
+    transaction that both appends them to balance_ledger and adds them to
+    users.balance. Balances and ledger therefore never disagree. A crash
+    loses at most the rewards buffered since the last flush.
+    """
+
+    def __init__(self, interval=0.3, max_entries=200):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = []
+        self._pending_by_user = collections.Counter()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.flushes = 0
+        self.entries_flushed = 0
+
+    def add(self, telegram_id, amount, reason, ref_id=None):
+        with self._lock:
+            self._entries.append((telegram_id, amount, reason, ref_id))
+            self._pending_by_user[telegram_id] += amount
+            full = len(self._entries) >= self.max_entries
+        if full:
+            self._wakeup.set()
+
+    def pending_amount(self, telegram_id):
+        """Buffered, not yet applied amount for a user (for display)."""
+        with self._lock:
+            return self._pending_by_user.get(telegram_id, 0)
+
+    async def flush(self):
+        async with self._flush_lock:
+            with self._lock:
+                entries, self._entries = self._entries, []
+            if not entries:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(DB_EXECUTOR, _apply_ledger_entries, entries)
+            except (psycopg2.Error, ConnectionError, psycopg2.pool.PoolError) as e:
+                logger.error("Ledger flush of %d entries failed, will retry: %s", len(entries), e)
+                with self._lock:
+                    self._entries[:0] = entries
+                return
+            with self._lock:
+                for telegram_id, amount, _, _ in entries:
+                    self._pending_by_user[telegram_id] -= amount
+                    if not self._pending_by_user[telegram_id]:
+                        del self._pending_by_user[telegram_id]
+            users_changed(*{e[0] for e in entries})
+            self.flushes += 1
+            self.entries_flushed += len(entries)
+
+    async def _run(self):
+        while True:
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        with self._lock:
+            buffered = len(self._entries)
+        return {"buffered": buffered, "flushes": self.flushes, "entries_flushed": self.entries_flushed}
+
+
+LEDGER = LedgerBuffer(interval=LEDGER_FLUSH_INTERVAL, max_entries=LEDGER_FLUSH_SIZE)
+
+
+# --- OUTBOUND NOTIFICATION QUEUE ---
+
+class RateLimiter:
+    """Async token bucket: at most `rate` acquisitions per second, `burst` at once."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Holds every acquirer back, e.g. after Telegram answered RetryAfter."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_after_seconds(exc):
+    delay = exc.retry_after
+    if isinstance(delay, datetime.timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class NotificationQueue:
+    """
+    Background sender for bot -> user/admin messages. Handlers enqueue() and
+    return; workers send under a global rate limit and a per-chat minimum
+    interval, retry RetryAfter and network errors with backoff, and drop
+    messages to chats that blocked the bot.
+    """
+
+    def __init__(self, rate=25, chat_interval=1.0, workers=4, max_retries=5):
+        self.limiter = RateLimiter(rate)
+        self.chat_interval = chat_interval
+        self.workers = workers
+        self.max_retries = max_retries
+        self._queue = asyncio.Queue()
+        self._tasks = []
+        self._bot = None
+        self._chat_next_send = {}  # chat_id -> monotonic time of next allowed send
+        self._delayed = 0  # items parked in call_later before re-entering the queue
+        self._in_flight = 0
+        self.sent = 0
+        self.retries = 0
+        self.blocked = 0
+        self.failed = 0
+        self._latencies = collections.deque(maxlen=1000)
+
+    def enqueue(self, chat_id, text, **kwargs):
+        self._queue.put_nowait((chat_id, text, kwargs, time.monotonic(), 0))
+
+    def _requeue_later(self, item, delay):
+        self._delayed += 1
+
+        def put():
+            self._delayed -= 1
+            self._queue.put_nowait(item)
+
+        asyncio.get_running_loop().call_later(delay, put)
+
+    def start(self, bot):
+        self._bot = bot
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=5.0):
+        """Gives queued messages up to `timeout` seconds to go out, then stops."""
+        deadline = time.monotonic() + timeout
+        while (self._queue.qsize() or self._delayed or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        unsent = self._queue.qsize() + self._delayed
+        if unsent:
+            logger.warning("Notification queue stopped with %d unsent message(s).", unsent)
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            self._in_flight += 1
+            try:
+                await self._send(item)
+            except Exception:
+                logger.exception("Notification worker error")
+            finally:
+                self._in_flight -= 1
+
+    async def _send(self, item):
+        chat_id, text, kwargs, enqueued_at, attempt = item
+        next_send = self._chat_next_send.get(chat_id, 0.0)
+        if next_send > time.monotonic():
+            self._requeue_later(item, next_send - time.monotonic())
+            return
+
+        await self.limiter.acquire()
+        # Other workers may have sent to this chat while we waited (e.g. out of a
+        # RetryAfter pause), so the per-chat slot is only taken now
+        now = time.monotonic()
+        next_send = self._chat_next_send.get(chat_id, 0.0)
+        if next_send > now:
+            self._requeue_later(item, next_send - now)
+            return
+        self._chat_next_send[chat_id] = now + self.chat_interval
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {c: t for c, t in self._chat_next_send.items() if t > now}
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            delay = _retry_after_seconds(e)
+            self.limiter.pause(delay)
+            self.retries += 1
+            self._requeue_later(item, delay)
+        except Forbidden:
+            # user blocked the bot; retrying won't help
+            self.blocked += 1
+        except BadRequest as e:
+            self.failed += 1
+            logger.error("Dropping notification to %s: %s", chat_id, e)
+        except NetworkError as e:
+            if attempt + 1 >= self.max_retries:
+                self.failed += 1
+                logger.error("Giving up on notification to %s after %d attempts: %s", chat_id, attempt + 1, e)
+            else:
+                self.retries += 1
+                self._requeue_later((chat_id, text, kwargs, enqueued_at, attempt + 1), min(60, 2 ** attempt))
+        except TelegramError as e:
+            self.failed += 1
+            logger.error("Dropping notification to %s: %s", chat_id, e)
+        else:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - enqueued_at)
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def pct(p):
+            if not latencies:
+                return 0.0
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        return {
+            "depth": self._queue.qsize() + self._delayed,
+            "sent": self.sent,
+            "retries": self.retries,
+            "blocked": self.blocked,
+            "failed": self.failed,
+            "latency_p50": pct(0.5),
+            "latency_p95": pct(0.95),
+            "latency_max": pct(1.0),
+        }
+
+
+NOTIFIER = NotificationQueue(
+    rate=NOTIFY_RATE, chat_interval=NOTIFY_CHAT_INTERVAL, workers=NOTIFY_WORKERS, max_retries=NOTIFY_MAX_RETRIES
+)
+
+
+# --- BROADCAST ---
+
+@db_helper
+def create_broadcast(text):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO broadcasts (text) VALUES (%s) RETURNING id", (text,))
+        broadcast_id = cur.fetchone()[0]
+        conn.commit()
+        return broadcast_id
+
+
+@db_helper
+def save_broadcast_progress(broadcast_id, last_telegram_id, delivered, blocked, failed, status="running"):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE broadcasts
+            SET last_telegram_id = %s, delivered = %s, blocked = %s, failed = %s, status = %s,
+                finished_at = CASE WHEN %s = 'running' THEN NULL ELSE NOW() END
+            WHERE id = %s
+            """,
+            (last_telegram_id, delivered, blocked, failed, status, status, broadcast_id),
+        )
+        conn.commit()
+
+
+@db_helper
+def get_running_broadcasts():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT id, text, last_telegram_id, delivered, blocked, failed FROM broadcasts WHERE status = 'running' ORDER BY id"
+        )
+        return cur.fetchall()
+
+
+def _open_recipient_cursor(broadcast_id, after):
+    """
+    Opens a server-side cursor over users after `after`, ordered by
+    telegram_id. WITH HOLD lets us commit right away, so no transaction stays
+    open while the broadcast runs; rows are then fetched in batches.
+    Returns (conn, cursor); the pooled connection is held until closed.
+    """
+    pool = get_pool()
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor(name=f"broadcast_{broadcast_id}", withhold=True)
+        cur.execute("SELECT telegram_id FROM users WHERE telegram_id > %s ORDER BY telegram_id", (after,))
+        conn.commit()
+    except BaseException:
+        pool.putconn(conn, discard=True)
+        raise
+    return conn, cur
+
+
+def _close_recipient_cursor(conn, cur):
+    try:
+        cur.close()
+        conn.commit()
+    except psycopg2.Error:
+        get_pool().putconn(conn, discard=True)
+    else:
+        get_pool().putconn(conn)
+
+
+# broadcast ids the admin asked to stop; checked between batches
+_cancelled_broadcasts = set()
+
+
+async def _broadcast_one(bot, limiter, semaphore, chat_id, text):
+    async with semaphore:
+        for attempt in range(5):
+            await limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return "delivered"
+            except RetryAfter as e:
+                delay = _retry_after_seconds(e)
+                limiter.pause(delay)
+                await asyncio.sleep(delay)
+            except Forbidden:
+                return "blocked"
+            except BadRequest:
+                return "failed"
+            except NetworkError:
+                await asyncio.sleep(2 ** attempt)
+            except TelegramError:
+                return "failed"
+        return "failed"
+
+
+async def run_broadcast(bot, broadcast_id, text, after=0, delivered=0, blocked=0, failed=0):
+    """
+    Sends `text` to every user with telegram_id > `after`, BROADCAST_BATCH
+    recipients at a time with BROADCAST_CONCURRENCY sends in flight, through
+    the same global rate limiter as NOTIFIER. Progress is saved after each
+    batch, so a restarted process resumes from the last finished batch.
+    """
+    loop = asyncio.get_running_loop()
+    counts = {"delivered": delivered, "blocked": blocked, "failed": failed}
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    started = last_report = time.monotonic()
+    sent_this_run = 0
+    status_message = None
+
+    async def report(state="running"):
+        nonlocal status_message
+        elapsed = time.monotonic() - started
+        rate = sent_this_run / elapsed if elapsed else 0.0
+        summary = (
+            f"📣 Broadcast #{broadcast_id} {state}\n"
+            f"Delivered: {counts['delivered']}\nBlocked: {counts['blocked']}\nFailed: {counts['failed']}\n"
+            f"Speed: {rate:.1f} msg/s"
+        )
+        try:
+            if status_message is None:
+                status_message = await bot.send_message(chat_id=ADMIN_ID, text=summary)
+            else:
+                await status_message.edit_text(summary)
+        except TelegramError as e:
+            logger.warning("Broadcast #%s status update failed: %s", broadcast_id, e)
+
+    await report()
+    conn, cur = await loop.run_in_executor(DB_EXECUTOR, _open_recipient_cursor, broadcast_id, after)
+    status = "finished"
+    try:
+        while True:
+            if broadcast_id in _cancelled_broadcasts:
+                status = "cancelled"
+                break
+            batch = await loop.run_in_executor(DB_EXECUTOR, cur.fetchmany, BROADCAST_BATCH)
+            if not batch:
+                break
+            results = await asyncio.gather(
+                *(_broadcast_one(bot, NOTIFIER.limiter, semaphore, chat_id, text) for (chat_id,) in batch)
+            )
+            for result in results:
+                counts[result] += 1
+            sent_this_run += len(results)
+            after = batch[-1][0]
+            await save_broadcast_progress(broadcast_id, after, **counts)
+            if time.monotonic() - last_report >= BROADCAST_REPORT_INTERVAL:
+                last_report = time.monotonic()
+                await report()
+    finally:
+        await loop.run_in_executor(DB_EXECUTOR, _close_recipient_cursor, conn, cur)
+
+    _cancelled_broadcasts.discard(broadcast_id)
+    await save_broadcast_progress(broadcast_id, after, status=status, **counts)
+    logger.info("Broadcast #%s %s: %s", broadcast_id, status, counts)
+    await report(status)
+
+
+# Broadcasts in progress. They can run for hours, so they are not started with
+# application.create_task (Application.stop() would wait for them); post_stop
+# cancels them and resume_broadcasts continues from the saved progress.
+_broadcast_tasks = set()
+
+
+def _broadcast_done(task):
+    _broadcast_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Broadcast failed", exc_info=task.exception())
+
+
+def start_broadcast(bot, broadcast_id, text, after=0, delivered=0, blocked=0, failed=0):
+    task = asyncio.create_task(run_broadcast(bot, broadcast_id, text, after, delivered, blocked, failed))
+    _broadcast_tasks.add(task)
+    task.add_done_callback(_broadcast_done)
+    return task
+
+
+async def stop_broadcasts():
+    """Cancels running broadcasts; they stay 'running' in the table and resume on the next start."""
+    tasks = list(_broadcast_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def resume_broadcasts(application):
+    """Restarts broadcasts that were still running when the process stopped."""
+    for broadcast_id, text, after, delivered, blocked, failed in await get_running_broadcasts():
+        logger.info("Resuming broadcast #%s after telegram_id %s", broadcast_id, after)
+        start_broadcast(application.bot, broadcast_id, text, after, delivered, blocked, failed)
+
+
+# --- PERSISTENT CONVERSATION STATE ---
+
+def _load_conversation_states():
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT telegram_id, data FROM conversation_state")
+        return {telegram_id: data for telegram_id, data in cur.fetchall()}
+
+
+def _load_conversation_state(telegram_id):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT data FROM conversation_state WHERE telegram_id = %s", (telegram_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+
+
+def _write_conversation_states(upserts, deletes):
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if upserts:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO conversation_state (telegram_id, data) VALUES %s
+                ON CONFLICT (telegram_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+                """,
+                [(telegram_id, psycopg2.extras.Json(data)) for telegram_id, data in upserts.items()],
+            )
+        if deletes:
+            cur.execute("DELETE FROM conversation_state WHERE telegram_id = ANY(%s)", (list(deletes),))
+        conn.commit()
+
+
+class PostgresPersistence(BasePersistence):
+    """
+    Keeps context.user_data (the withdraw flow state) in the
+    conversation_state table so it survives restarts.
+
+    The Application hands us changed user_data every `update_interval`
+    seconds; we diff it against what is already stored and write the
+    changes in one batched transaction, so handlers never wait on a DB write.
+    Users with an empty state have no row. With `shared=True` (several
+    instances behind one webhook) user_data is re-read before each update,
+    unless this instance has a newer, not yet flushed change for that user.
+    """
+
+    def __init__(self, update_interval=2.0, shared=False):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.shared = shared
+        self._stored = {}  # telegram_id -> data as last written/read
+        self._pending = {}  # telegram_id -> data to write ({} means delete)
+        self._inflight = {}  # batch currently being written
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    async def get_user_data(self):
+        loop = asyncio.get_running_loop()
+        self._stored = await loop.run_in_executor(DB_EXECUTOR, _load_conversation_states)
+        logger.info("Restored %d in-progress conversation state(s).", len(self._stored))
+        return {telegram_id: dict(data) for telegram_id, data in self._stored.items()}
+
+    async def update_user_data(self, user_id, data):
+        # A batch being written is what the table will hold once it lands
+        if data == self._inflight.get(user_id, self._stored.get(user_id, {})):
+            self._pending.pop(user_id, None)
+            return
+        self._pending[user_id] = data
+        if self._flush_task is None or self._flush_task.done():
+            # Runs after the Application has handed over the whole batch
+            self._flush_task = asyncio.create_task(self.flush())
+
+    async def drop_user_data(self, user_id):
+        await self.update_user_data(user_id, {})
 
-def get_conn():
-    """Establishes and returns a PostgreSQL connection."""
-    try:
-        # ** নিশ্চিত করুন যে **DB_PARAMS এ host ও port আছে
-        return psycopg2.connect(**DB_PARAMS)
-    except psycopg2.OperationalError as e:
-        logger.error(f"Database connection failed: {e}")
-        # সংযোগ ব্যর্থ হলে স্পষ্ট ত্রুটি দেখাবে
-        raise ConnectionError("Failed to connect to the external PostgreSQL database.")
+    async def refresh_user_data(self, user_id, user_data):
+        if not self.shared or user_id in self._pending or user_id in self._inflight:
+            return
+        loop = asyncio.get_running_loop()
+        stored = await loop.run_in_executor(DB_EXECUTOR, _load_conversation_state, user_id) or {}
+        if stored != user_data:
+            user_data.clear()
+            user_data.update(stored)
+        if stored:
+            self._stored[user_id] = stored
+        else:
+            self._stored.pop(user_id, None)
 
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            upserts = {uid: data for uid, data in batch.items() if data}
+            deletes = [
+                uid for uid, data in batch.items() if not data and (uid in self._stored or uid in self._inflight)
+            ]
+            if not upserts and not deletes:
+                return
+            self._inflight = batch
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(DB_EXECUTOR, _write_conversation_states, upserts, deletes)
+            except (psycopg2.Error, ConnectionError, psycopg2.pool.PoolError) as e:
+                logger.error("Conversation state flush failed, will retry: %s", e)
+                for uid, data in batch.items():
+                    self._pending.setdefault(uid, data)
+                return
+            finally:
+                self._inflight = {}
+            self._stored.update(upserts)
+            for uid in deletes:
+                self._stored.pop(uid, None)
+            self.flushes += 1
+            self.rows_written += len(upserts) + len(deletes)
 
-def init_db():
-    """Initializes tables using PostgreSQL syntax."""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Using BIGSERIAL for auto-increment and TIMESTAMP WITH TIME ZONE for time data
-    cur.execute("""
-        -- users table
-        CREATE TABLE IF NOT EXISTS users (
-            id BIGSERIAL PRIMARY KEY,
-            telegram_id BIGINT UNIQUE NOT NULL,
-            first_name TEXT,
-            username TEXT,
-            balance BIGINT DEFAULT 0, 
-            bonus_given INTEGER DEFAULT 0,
-            referred_by BIGINT DEFAULT NULL,
-            referrals_count INTEGER DEFAULT 0,
-            tasks_done_date TEXT DEFAULT NULL,
-            tasks_done_count INTEGER DEFAULT 0,
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-        );
-        
-        -- withdrawals table
-        CREATE TABLE IF NOT EXISTS withdrawals (
-            id BIGSERIAL PRIMARY KEY,
-            telegram_id BIGINT,
-            method TEXT,
-            account TEXT,
-            amount BIGINT,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-            processed_at TIMESTAMP WITH TIME ZONE DEFAULT NULL
-        );
-    """)
-    conn.commit()
-    conn.close()
+    # Only user_data is persisted; the rest of the interface is a no-op.
+    async def get_chat_data(self):
+        return {}
 
+    async def get_bot_data(self):
+        return {}
 
-def get_user(telegram_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    # Note: Using %s placeholder for psycopg2
-    cur.execute("SELECT * FROM users WHERE telegram_id=%s", (telegram_id,)) 
-    row = cur.fetchone()
-    conn.close()
-    return row
+    async def get_callback_data(self):
+        return None
 
+    async def get_conversations(self, name):
+        return {}
 
-def add_user(telegram_id, first_name="", username="", referred_by=None):
-    conn = get_conn()
-    cur = conn.cursor()
-    # Insert new user - ON CONFLICT DO NOTHING prevents errors if user exists
-    cur.execute(
-        "INSERT INTO users (telegram_id, first_name, username, referred_by) VALUES (%s, %s, %s, %s) ON CONFLICT (telegram_id) DO NOTHING",
-        (telegram_id, first_name, username, referred_by),
-    )
-    
-    # Handle referral bonus if a new user was inserted AND referred_by is set
-    # cur.rowcount > 0 means the INSERT INTO was successful (new user added)
-    if referred_by and cur.rowcount > 0: 
-        if referred_by != telegram_id and get_user(referred_by):
-            cur.execute(
-                "UPDATE users SET referrals_count = referrals_count + 1, balance = balance + %s WHERE telegram_id=%s",
-                (REF_BONUS, referred_by),
-            )
-    conn.commit()
-    conn.close()
+    async def update_conversation(self, name, key, new_state):
+        pass
 
+    async def update_chat_data(self, chat_id, data):
+        pass
 
-def give_signup_bonus_if_needed(telegram_id, amount=SIGNUP_BONUS): 
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT bonus_given FROM users WHERE telegram_id=%s", (telegram_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return False
-    if row[0] == 0:
-        cur.execute(
-            "UPDATE users SET balance = balance + %s, bonus_given = 1 WHERE telegram_id=%s",
-            (amount, telegram_id),
-        )
-        conn.commit()
-        conn.close()
-        return True
-    conn.close()
-    return False
+    async def update_bot_data(self, data):
+        pass
 
+    async def update_callback_data(self, data):
+        pass
 
-def get_balance(telegram_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT balance FROM users WHERE telegram_id=%s", (telegram_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else 0
+    async def drop_chat_data(self, chat_id):
+        pass
 
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
 
-def add_balance(telegram_id, amount):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET balance = balance + %s WHERE telegram_id=%s", (amount, telegram_id))
-    conn.commit()
-    conn.close()
+    async def refresh_bot_data(self, bot_data):
+        pass
 
+    def stats(self):
+        return {
+            "stored": len(self._stored),
+            "pending": len(self._pending),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+        }
 
-def record_task_done(telegram_id):
-    today = datetime.date.today().isoformat()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT tasks_done_date, tasks_done_count FROM users WHERE telegram_id=%s", (telegram_id,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
-        return (0, False)
-    tdate, tcount = row
-    
-    if tdate is None or tdate != today:
-        tcount = 0
-        tdate = today
-    
-    if tcount >= DAILY_TASK_LIMIT:
-        conn.close()
-        return (tcount, False)
-    
-    tcount += 1
-    cur.execute("UPDATE users SET tasks_done_date=%s, tasks_done_count=%s WHERE telegram_id=%s", (today, tcount, telegram_id))
-    conn.commit()
-    conn.close()
-    return (tcount, True)
-
-
-def save_withdraw_request(telegram_id, method, account, amount):
-    conn = get_conn()
-    cur = conn.cursor()
-    # RETURNING id is PostgreSQL syntax to get the newly created ID
-    cur.execute(
-        "INSERT INTO withdrawals (telegram_id, method, account, amount) VALUES (%s, %s, %s, %s) RETURNING id",
-        (telegram_id, method, account, amount),
-    )
-    withdraw_id = cur.fetchone()[0] # Fetch the ID of the new row
-    conn.commit()
-    conn.close()
-    return withdraw_id # Return the ID
-
-
-def update_withdraw_status(withdraw_id, status):
-    conn = get_conn()
-    cur = conn.cursor()
-    # NOW() is PostgreSQL function for current timestamp
-    cur.execute(
-        "UPDATE withdrawals SET status=%s, processed_at=NOW() WHERE id=%s",
-        (status, withdraw_id),
-    )
-    conn.commit()
-    conn.close()
 
-def get_withdraw_details(withdraw_id):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT telegram_id, amount FROM withdrawals WHERE id=%s", (withdraw_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row 
+CONVERSATION_STATE = PostgresPersistence(update_interval=STATE_FLUSH_INTERVAL, shared=STATE_SHARED)
 
 
 # --- TELEGRAM HANDLERS (Same logic as before) ---
@@ -261,6 +2511,7 @@ MAIN_MENU_KBD = ReplyKeyboardMarkup(
 )
 
 
+@timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_user = update.effective_user
     tid = tg_user.id
@@ -274,8 +2525,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             referred_by = None
 
-    add_user(tid, first_name=tg_user.first_name or "", username=tg_user.username or "", referred_by=referred_by)
-    given = give_signup_bonus_if_needed(tid, amount=SIGNUP_BONUS)
+    _, given, _ = await register_user(
+        tid, first_name=tg_user.first_name or "", username=tg_user.username or "",
+        referred_by=referred_by, bonus=SIGNUP_BONUS,
+    )
     text = f"স্বাগতম, {tg_user.first_name or 'বন্ধু'}!\n\n"
     if given:
         text += f"🎉 আপনার এককালীন বোনাস Tk {SIGNUP_BONUS} দেওয়া হয়েছে।\n"
@@ -285,6 +2538,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, reply_markup=MAIN_MENU_KBD)
 
 
+@timed_handler
 async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text or ""
     tid = update.effective_user.id
@@ -294,14 +2548,18 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
     if text in ["💰 ইনকাম শুরু করুন", "👥 রেফারেল সিস্টেম", "💸 উইথড্র", "ℹ️ টিউটোরিয়াল"]:
+        if not THROTTLE.allow(tid, "menu"):
+            # Repeated taps within a second or two; the previous reply is still on screen
+            set_branch("throttled")
+            return
         context.user_data.clear()
 
     if text == "💰 ইনকাম শুরু করুন":
-        
-        balance = get_balance(tid)
-        user_row = get_user(tid)
-        # Index 9 is tasks_done_count in the SELECT * query
-        tdone = user_row[9] if user_row and len(user_row) > 9 else 0 
+        set_branch("dashboard")
+        # One (usually cached) record serves both balance and today's task count
+        user = await get_user(tid)
+        balance = (user.balance if user else 0) + LEDGER.pending_amount(tid)
+        tdone = user.tasks_today if user else 0
 
         await update.message.reply_text(
             f"ড্যাশবোর্ড\n\nবর্তমান ব্যালেন্স: Tk {balance}\nআজকের টাস্ক সম্পন্ন: {tdone}/{DAILY_TASK_LIMIT}\nপ্রতি টাস্কের রিওয়ার্ড: Tk {TASK_REWARD}\n\nবাছাই করুন:",
@@ -314,9 +2572,10 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif text == "👥 রেফারেল সিস্টেম":
+        set_branch("referral")
         ref_link = f"t.me/{context.bot.username}?start={tid}"
-        user = get_user(tid)
-        referrals = user[7] if user and len(user) > 7 else 0  # referrals_count
+        user = await get_user(tid)
+        referrals = user.referrals_count if user else 0
         await update.message.reply_text(
             f"আপনার রেফারেল লিঙ্ক:\n`{ref_link}`\n\nআপনি মোট {referrals} জনকে রেফার করেছেন।\nপ্রতিটি সফল রেফারে রেফারারকে Tk {REF_BONUS} বোনাস দেওয়া হয়।",
             parse_mode='Markdown',
@@ -324,7 +2583,9 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif text == "💸 উইথড্র":
-        balance = get_balance(tid)
+        set_branch("withdraw_start")
+        # Same figure as the dashboard: committed balance plus rewards not yet flushed
+        balance = await get_balance(tid) + LEDGER.pending_amount(tid)
         await update.message.reply_text(
             f"আপনার ব্যালেন্স: Tk {balance}\n\nনূ্যতম উইথড্র: Tk {MIN_WITHDRAW}\nকত টাকা উইথড্র করতে চান? (সংখ্যা লিখে পাঠান)\nউদাহরণ: {MIN_WITHDRAW}",
             reply_markup=ReplyKeyboardRemove(),
@@ -332,6 +2593,7 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data["expect_withdraw_amount"] = True
     
     elif text == "ℹ️ টিউটোরিয়াল":
+        set_branch("tutorial")
         await update.message.reply_text(
             f"টিউটোরিয়াল:\n\n1) **ইনকাম শুরু করুন** > **বিজ্ঞাপন দেখুন** > বিজ্ঞাপনটি দেখার পর 'I finished' ক্লিক করলে টাকা ক্রেডিট হবে।\n2) **রেফারেল সিস্টেম** থেকে আপনার লিঙ্কটি বন্ধুদের সাথে শেয়ার করুন।\n3) **উইথড্র** করতে নূন্যতম Tk {MIN_WITHDRAW} ব্যালেন্স প্রয়োজন।"
         )
@@ -339,9 +2601,14 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- State Handling for Withdraw ---
     
     elif expect_withdraw_amount and text.isdigit():
+        set_branch("withdraw_amount")
         context.user_data["expect_withdraw_amount"] = False
         amount = int(text)
-        balance = get_balance(tid)
+        balance = await get_balance(tid)
+        if amount > balance and LEDGER.pending_amount(tid):
+            # The menu counted buffered rewards; commit them so the check sees them too
+            await LEDGER.flush()
+            balance = await get_balance(tid)
         
         if amount < MIN_WITHDRAW:
             await update.message.reply_text(f"নূ্যতম উইথড্র হল Tk {MIN_WITHDRAW}. আবার চেষ্টা করুন।", reply_markup=MAIN_MENU_KBD)
@@ -351,6 +2618,8 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.clear()
         else:
             context.user_data["pending_withdraw_amount"] = amount
+            # Identifies this withdraw flow, so a repeated final message can't submit twice
+            context.user_data["withdraw_key"] = uuid.uuid4().hex
             
             await update.message.reply_text(
                 "পেমেন্ট পদ্ধতি বাছাই করুন:\n1) Bkash\n2) Nagad\n3) Rocket\n\nউপরোক্ত নামগুলির মধ্যে যেকোনো একটি টাইপ করুন (উদাহরণ: Bkash)",
@@ -359,6 +2628,7 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data["expect_withdraw_method"] = True
     
     elif context.user_data.get("expect_withdraw_method"):
+        set_branch("withdraw_method")
         method = text.strip().lower()
         if method in ["bkash", "nagad", "rocket"]:
             context.user_data["expect_withdraw_method"] = False
@@ -370,36 +2640,44 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("দয়া করে সঠিক পেমেন্ট পদ্ধতির নাম লিখুন (Bkash/Nagad/Rocket):")
 
     elif context.user_data.get("expect_withdraw_account"):
+        set_branch("withdraw_account")
         context.user_data["expect_withdraw_account"] = False
         
         method = context.user_data.pop("pending_withdraw_method")
         account = text.strip()
         amount = context.user_data.pop("pending_withdraw_amount", 0)
+        withdraw_key = context.user_data.pop("withdraw_key", None) or uuid.uuid4().hex
         
-        # Deduct balance immediately
-        add_balance(tid, -amount)
-        withdraw_id = save_withdraw_request(tid, method, account, amount)
+        # Balance check, deduction and request in one statement
+        status, withdraw_id = await submit_withdrawal(tid, method, account, amount, withdraw_key)
+        if status == "insufficient":
+            await update.message.reply_text("আপনার ব্যালেন্স পর্যাপ্ত নেই।", reply_markup=MAIN_MENU_KBD)
+            context.user_data.clear()
+            return
+        if status == "duplicate":
+            await update.message.reply_text(
+                f"এই উইথড্র রিকোয়েস্ট (ID: {withdraw_id}) আগেই জমা হয়েছে।", reply_markup=MAIN_MENU_KBD
+            )
+            context.user_data.clear()
+            return
         
-        # notify admin
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_ID,
-                text=f"🚨 নতুন উইথড্র রিকোয়েস্ট (ID: {withdraw_id})\n"
-                     f"User: {update.effective_user.full_name} (`{tid}`)\n"
-                     f"Amount: Tk {amount}\nMethod: {method}\nAccount: `{account}`\n\n"
-                     f"Admin Action:",
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup(
+        # notify admin (queued; the handler doesn't wait on Telegram)
+        NOTIFIER.enqueue(
+            ADMIN_ID,
+            f"🚨 নতুন উইথড্র রিকোয়েস্ট (ID: {withdraw_id})\n"
+            f"User: {escape_markdown(update.effective_user.full_name)} (`{tid}`)\n"
+            f"Amount: Tk {amount}\nMethod: {method}\nAccount: {escape_markdown(account)}\n\n"
+            f"Admin Action:",
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup(
+                [
                     [
-                        [
-                            InlineKeyboardButton("✅ Approve", callback_data=f"w_approve_{withdraw_id}"),
-                            InlineKeyboardButton("❌ Reject", callback_data=f"w_reject_{withdraw_id}"),
-                        ]
+                        InlineKeyboardButton("✅ Approve", callback_data=f"w_approve_{withdraw_id}"),
+                        InlineKeyboardButton("❌ Reject", callback_data=f"w_reject_{withdraw_id}"),
                     ]
-                )
-            )
-        except Exception as e:
-            logger.error("Failed to notify admin: %s", e)
+                ]
+            ),
+        )
         
         await update.message.reply_text(
             f"আপনার উইথড্র রিকোয়েস্ট (Tk {amount}) জমা হয়েছে।\nঅ্যাডমিন রিভিউ করবেন। ⏳", 
@@ -408,6 +2686,7 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data.clear()
     
     else:
+        set_branch("other")
         if any(key in context.user_data for key in ["expect_withdraw_amount", "expect_withdraw_method", "expect_withdraw_account"]):
             context.user_data.clear()
             await update.message.reply_text("উইথড্রয়াল রিকোয়েস্ট বাতিল করা হয়েছে। মেনু থেকে আবার চেষ্টা করুন।", reply_markup=MAIN_MENU_KBD)
@@ -415,13 +2694,26 @@ async def message_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("আর্জি বুঝতে পারিনি। মেনু থেকে বাছাই করুন।", reply_markup=MAIN_MENU_KBD)
 
 
+@timed_handler
 async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await q.answer()
     data = q.data
     tid = q.from_user.id
-    
+
+    # "I finished" spam is answered from memory, before any query
+    if data == "ad_finished":
+        if THROTTLE.limit_reached(tid):
+            set_branch("ad_finished_limit")
+            await q.answer(f"আপনি আজকের সর্বোচ্চ টাস্ক সীমা {DAILY_TASK_LIMIT} ব্যবহার করেছেন।")
+            return
+        if not THROTTLE.allow(tid, "ad"):
+            set_branch("throttled")
+            await q.answer("একটু অপেক্ষা করে আবার চেষ্টা করুন।")
+            return
+
+    await q.answer()
     if data == "watch_ad":
+        set_branch("watch_ad")
         context.user_data.clear()
 
         await q.edit_message_text(
@@ -430,16 +2722,24 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         )
     
     elif data == "ad_finished":
-        count, allowed = record_task_done(tid)
+        set_branch("ad_finished")
+        credit = TASK_REWARD
+        # Limit check and counter increment in one round-trip
+        count, balance, allowed = await credit_task(tid)
         
         if not allowed:
+            set_branch("ad_finished_limit")
+            if count >= DAILY_TASK_LIMIT:
+                THROTTLE.mark_limit_reached(tid)
             await q.edit_message_text(f"আপনি আজকের সর্বোচ্চ টাস্ক সীমা **{DAILY_TASK_LIMIT}** ব্যবহার করেছেন।", 
                                       reply_markup=MAIN_MENU_KBD)
             return
-        
-        credit = TASK_REWARD
-        add_balance(tid, credit)
-        balance = get_balance(tid)
+
+        if count >= DAILY_TASK_LIMIT:
+            THROTTLE.mark_limit_reached(tid)
+        # The reward reaches the ledger and users.balance with the next batch
+        LEDGER.add(tid, credit, "task_reward")
+        balance += LEDGER.pending_amount(tid)
         
         await q.edit_message_text(
             f"ধন্যবাদ! Tk {credit} ক্রেডিট হয়েছে।\nআপনার বর্তমান ব্যালেন্স Tk {balance}।\n(আজকের টাস্ক সম্পন্ন: **{count}/{DAILY_TASK_LIMIT}**)", 
@@ -447,88 +2747,311 @@ async def callback_query_handler(update: Update, context: ContextTypes.DEFAULT_T
         )
         
     elif data.startswith("w_approve_") or data.startswith("w_reject_"):
+        set_branch("withdraw_review")
         if tid != ADMIN_ID:
             await q.answer("আপনি অ্যাডমিন নন।")
             return
             
-        action, withdraw_id = data.split('_')[1], int(data.split('_')[2])
-        withdraw_details = get_withdraw_details(withdraw_id)
+        parts = data.split('_')
+        action, withdraw_id = parts[1], int(parts[2])
+        # Buttons on a /withdraws page carry the page cursor as a 4th field
+        page_cursor = parts[3] if len(parts) > 3 else None
+        status = "approved" if action == "approve" else "rejected"
+        processed = await process_withdrawals(status, ids=[withdraw_id])
         
-        if not withdraw_details:
-             await q.edit_message_text("উইথড্রয়াল আইডি খুঁজে পাওয়া যায়নি।")
+        if not processed and not page_cursor:
+             await q.edit_message_text("উইথড্রয়াল আইডি খুঁজে পাওয়া যায়নি বা আগেই প্রসেস করা হয়েছে।")
              return
-             
-        w_tid, w_amount = withdraw_details
-        
-        if action == "approve":
-            update_withdraw_status(withdraw_id, "approved")
-            status_text = "✅ অনুমোদিত (পেমেন্ট সম্পন্ন)"
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=w_tid,
-                    text=f"🎉 আপনার Tk {w_amount} উইথড্রয়াল রিকোয়েস্ট **অনুমোদিত (Approved)** হয়েছে এবং পেমেন্ট সম্পন্ন হয়েছে। ধন্যবাদ!"
-                )
-            except Exception:
-                logger.error(f"Failed to notify user {w_tid} about approved withdraw {withdraw_id}")
 
-        elif action == "reject":
-            update_withdraw_status(withdraw_id, "rejected")
+        notify_withdraw_results(status, processed)
+        if not processed:
+            status_text = "আগেই প্রসেস করা হয়েছে"
+        elif action == "approve":
+            status_text = "✅ অনুমোদিত (পেমেন্ট সম্পন্ন)"
+        else:
             status_text = "❌ বাতিল (ব্যালেন্স রিফান্ড)"
-            
-            add_balance(w_tid, w_amount)
-            
-            try:
-                await context.bot.send_message(
-                    chat_id=w_tid,
-                    text=f"❌ দুঃখিত! আপনার Tk {w_amount} উইথড্রয়াল রিকোয়েস্ট **বাতিল (Rejected)** হয়েছে। কারণ জানতে অ্যাডমিনের সাথে যোগাযোগ করুন। আপনার ব্যালেন্স রিফান্ড করা হয়েছে।"
-                )
-            except Exception:
-                logger.error(f"Failed to notify user {w_tid} about rejected withdraw {withdraw_id}")
+
+        if page_cursor:
+            text, markup = await build_withdraw_page(decode_withdraw_cursor(page_cursor), "from")
+            await q.edit_message_text(
+                f"WID {withdraw_id}: {status_text}\n\n{text}", parse_mode='Markdown', reply_markup=markup
+            )
+            return
 
         await q.edit_message_text(
             q.message.text + f"\n\n--- Processed ---\nStatus: {status_text} by Admin.",
             reply_markup=None
         )
 
+    elif data.startswith("wb_") and data != "wb_cancel":
+        set_branch("withdraw_bulk")
+        if tid != ADMIN_ID:
+            await q.answer("আপনি অ্যাডমিন নন।")
+            return
+        # wb_<approve|reject>_<newest cursor>_<oldest cursor or 0>
+        _, action, newest, oldest = data.split('_')
+        status = "approved" if action == "approve" else "rejected"
+        started = time.monotonic()
+        processed = await process_withdrawals(
+            status,
+            newest=decode_withdraw_cursor(newest),
+            oldest=decode_withdraw_cursor(oldest) if oldest != "0" else None,
+        )
+        elapsed_ms = (time.monotonic() - started) * 1000
+        notify_withdraw_results(status, processed)
+        summary = (
+            f"{status.capitalize()} {len(processed)} withdrawal(s), "
+            f"Tk {sum(r[2] for r in processed)} in {elapsed_ms:.0f} ms."
+        )
+        logger.info("Bulk withdraw action by admin: %s", summary)
+        if oldest == "0":
+            await q.edit_message_text(summary, reply_markup=None)
+            return
+        text, markup = await build_withdraw_page(decode_withdraw_cursor(newest), "from")
+        await q.edit_message_text(f"{summary}\n\n{text}", parse_mode='Markdown', reply_markup=markup)
+
+    elif data == "wb_cancel":
+        set_branch("withdraw_bulk_cancel")
+        await q.edit_message_text("Cancelled.", reply_markup=None)
+
+    elif data.startswith("wl_"):
+        set_branch("withdraw_page")
+        if tid != ADMIN_ID:
+            await q.answer("আপনি অ্যাডমিন নন।")
+            return
+        _, direction, token = data.split('_', 2)
+        text, markup = await build_withdraw_page(decode_withdraw_cursor(token), direction)
+        await q.edit_message_text(text, parse_mode='Markdown', reply_markup=markup)
+
     elif data == "noop":
+        set_branch("noop")
         pass 
         
     else:
+        set_branch("other")
         await q.edit_message_text("অজানা অপশন।", reply_markup=MAIN_MENU_KBD)
 
 
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def _to_base36(n):
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = _B36[r] + digits
+        if n == 0:
+            return digits
+
+
+def encode_withdraw_cursor(created_at, withdraw_id):
+    """Packs a (created_at, id) keyset cursor into a short callback_data token."""
+    micros = (created_at - _EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{_to_base36(micros)}.{_to_base36(withdraw_id)}"
+
+
+def decode_withdraw_cursor(token):
+    micros, withdraw_id = token.split(".")
+    return _EPOCH + datetime.timedelta(microseconds=int(micros, 36)), int(withdraw_id, 36)
+
+
+async def build_withdraw_page(cursor=None, direction="older"):
+    """Renders one /withdraws page as (text, reply_markup)."""
+    rows, has_more, has_back = await get_pending_withdraws_page(cursor, direction)
+    if not rows and direction != "older":
+        # Everything newer was processed meanwhile; fall back to the first page
+        rows, has_more, has_back = await get_pending_withdraws_page()
+        cursor, direction = None, "older"
+    if not rows:
+        return "No pending withdrawals.", None
+
+    first = encode_withdraw_cursor(rows[0].created_at, rows[0].id)
+    last = encode_withdraw_cursor(rows[-1].created_at, rows[-1].id)
+    lines = ["Pending withdrawals (newest first):"]
+    buttons = []
+    for w in rows:
+        # Typed by the user: a code span can't hold a backtick in Markdown v1, so escape it as text
+        account = escape_markdown(w.account[:64])
+        lines.append(
+            f"\n--- WID: {w.id} ---\nUser: `{w.telegram_id}`\nAmount: Tk {w.amount}\nMethod: {w.method}\nAccount: {account}\nRequested: {w.created_at.strftime('%Y-%m-%d %H:%M:%S')}"
+        )
+        # The page's first cursor lets the callback redraw this page afterwards
+        buttons.append([
+            InlineKeyboardButton(f"✅ Approve #{w.id}", callback_data=f"w_approve_{w.id}_{first}"),
+            InlineKeyboardButton(f"❌ Reject #{w.id}", callback_data=f"w_reject_{w.id}_{first}"),
+        ])
+
+    has_newer = has_more if direction == "newer" else has_back
+    has_older = has_back if direction == "newer" else has_more
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"wl_newer_{first}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"wl_older_{last}"))
+    if nav:
+        buttons.append(nav)
+    buttons.append([
+        InlineKeyboardButton("✅ Approve page", callback_data=f"wb_approve_{first}_{last}"),
+        InlineKeyboardButton("❌ Reject page", callback_data=f"wb_reject_{first}_{last}"),
+    ])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+
+@timed_handler
 async def admin_withdraws(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
         return
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, telegram_id, method, account, amount, status, created_at FROM withdrawals WHERE status='pending' ORDER BY created_at DESC")
-    rows = cur.fetchall()
-    conn.close()
-    if not rows:
+    text, markup = await build_withdraw_page()
+    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=markup)
+
+
+@timed_handler
+async def admin_approve_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    count, total, newest = await get_pending_withdraws_summary()
+    if not count:
         await update.message.reply_text("No pending withdrawals.")
         return
-        
-    for r in rows:
-        wid, tid, method, account, amount, status, created_at = r
-        
-        await update.message.reply_text(
-            f"--- WID: {wid} ---\nUser: `{tid}`\nAmount: Tk {amount}\nMethod: {method}\nAccount: `{account}`\nRequested: {created_at.strftime('%Y-%m-%d %H:%M:%S')}",
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup(
-                [
-                    [
-                        InlineKeyboardButton("✅ Approve", callback_data=f"w_approve_{wid}"),
-                        InlineKeyboardButton("❌ Reject (Refund)", callback_data=f"w_reject_{wid}"),
-                    ]
-                ]
+    # Only requests up to the newest one seen now; later arrivals stay pending
+    cursor = encode_withdraw_cursor(*newest)
+    await update.message.reply_text(
+        f"Approve all {count} pending withdrawals (Tk {total})?",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Confirm", callback_data=f"wb_approve_{cursor}_0"),
+            InlineKeyboardButton("Cancel", callback_data="wb_cancel"),
+        ]]),
+    )
+
+
+@timed_handler
+async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    parts = (update.message.text or "").split(maxsplit=1)
+    if len(parts) < 2 or not parts[1].strip():
+        await update.message.reply_text("Usage: /broadcast <message text>")
+        return
+    broadcast_id = await create_broadcast(parts[1])
+    start_broadcast(context.bot, broadcast_id, parts[1])
+    await update.message.reply_text(
+        f"Broadcast #{broadcast_id} started. Stop it with /broadcast_cancel {broadcast_id}"
+    )
+
+
+@timed_handler
+async def admin_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Usage: /broadcast_cancel <id>")
+        return
+    _cancelled_broadcasts.add(int(context.args[0]))
+    await update.message.reply_text(f"Broadcast #{context.args[0]} will stop after the current batch.")
+
+
+@timed_handler
+async def admin_reconcile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    await LEDGER.flush()
+    count, rows = await reconcile_balances(limit=20)
+    if not count:
+        await update.message.reply_text("✅ All balances match the ledger.")
+        return
+    lines = [f"⚠️ {count} balance(s) differ from the ledger:"]
+    lines += [f"{tid}: balance {balance}, ledger {total}" for tid, balance, total in rows]
+    await update.message.reply_text("\n".join(lines))
+
+
+EXPORT_USAGE = (
+    "Usage:\n/export withdrawals [pending|approved|rejected] [from YYYY-MM-DD] [to YYYY-MM-DD]\n"
+    "/export users [from YYYY-MM-DD] [to YYYY-MM-DD]"
+)
+# Bot API upload limit for documents
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+
+
+@timed_handler
+async def admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    args = context.args or []
+    if not args or args[0] not in EXPORT_QUERIES:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    kind, status, dates = args[0], None, []
+    set_branch(kind)
+    for arg in args[1:]:
+        if kind == "withdrawals" and arg in ("pending", "approved", "rejected"):
+            status = arg
+            continue
+        try:
+            dates.append(datetime.date.fromisoformat(arg))
+        except ValueError:
+            await update.message.reply_text(EXPORT_USAGE)
+            return
+    if len(dates) > 2:
+        await update.message.reply_text(EXPORT_USAGE)
+        return
+    since, until = (dates + [None, None])[:2]
+
+    started = time.monotonic()
+    out, size = await export_csv(kind, status=status, since=since, until=until)
+    with out:
+        if size > EXPORT_MAX_BYTES:
+            await update.message.reply_text(
+                f"Export is {size / 1024 / 1024:.0f} MB, over Telegram's 50 MB limit. Narrow the date range."
             )
+            return
+        name = "_".join(str(p) for p in (kind, status, since, until) if p) + ".csv"
+        # Let the HTTP client stream the file instead of reading it into memory
+        await update.message.reply_document(
+            document=InputFile(out, filename=name, read_file_handle=False),
+            caption=f"{name}: {size / 1024:.0f} KB in {time.monotonic() - started:.1f}s",
         )
-    await update.message.reply_text(f"Total {len(rows)} pending requests listed.")
 
 
+@timed_handler
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats shows the summary; `/stats rebuild` corrects it against the tables first."""
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("আপনি এটি চালাতে পারবেন না।")
+        return
+    rebuild = bool(context.args) and context.args[0] == "rebuild"
+    set_branch("rebuild" if rebuild else "read")
+    stats = await get_admin_stats(rebuild=rebuild)
+    buffered = LEDGER.stats()["buffered"]
+    text = (
+        f"📊 Stats{' (rebuilt)' if rebuild else ''}\n\n"
+        f"Users: {stats['users']} (+{stats['signups_today']} today)\n"
+        f"Tasks completed today: {stats['tasks_today']}\n"
+        f"Balance liability: Tk {stats['balance']}\n"
+        f"Pending withdrawals: {stats['pending_count']} (Tk {stats['pending_amount']})"
+    )
+    if buffered:
+        text += f"\n\n{buffered} task reward(s) not yet applied to balances."
+    await update.message.reply_text(text)
+
+
+def notify_withdraw_results(status, rows):
+    """Queues the approved/rejected messages for the users of processed withdrawals."""
+    for withdraw_id, w_tid, w_amount in rows:
+        if status == "approved":
+            text = f"🎉 আপনার Tk {w_amount} উইথড্রয়াল রিকোয়েস্ট **অনুমোদিত (Approved)** হয়েছে এবং পেমেন্ট সম্পন্ন হয়েছে। ধন্যবাদ!"
+        else:
+            text = f"❌ দুঃখিত! আপনার Tk {w_amount} উইথড্রয়াল রিকোয়েস্ট **বাতিল (Rejected)** হয়েছে। কারণ জানতে অ্যাডমিনের সাথে যোগাযোগ করুন। আপনার ব্যালেন্স রিফান্ড করা হয়েছে।"
+        NOTIFIER.enqueue(w_tid, text)
+
+
+@timed_handler
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "এই বটের মেনুভিত্তিক কমান্ডগুলো ব্যবহার করুন।\n\n"
@@ -539,29 +3062,367 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-def main():
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN is not set in the .env file.")
-        return
+# --- EMBEDDED HTTP SERVER (webhook, health checks, metrics) ---
 
-    # Initialize the database and create tables
-    init_db()
-    
-    if not ADMIN_ID:
-         logger.warning("ADMIN_ID is not set in the .env file. Admin commands will not work.")
+class HttpServer:
+    """
+    Minimal asyncio HTTP/1.1 server with exact-path routing. Enough for the
+    Telegram webhook on Render without pulling in a web framework; handlers
+    are `async def handler(headers, body) -> (status, content_type, payload)`.
+    """
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    MAX_BODY = 1024 * 1024
+    KEEPALIVE_TIMEOUT = 75
+    HEADER_TIMEOUT = 10
+    # Telegram opens at most 100 webhook connections; the rest is health checks
+    MAX_CONNECTIONS = 256
 
+    def __init__(self):
+        self.routes = {}
+        self._server = None
+        self._connections = 0
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self, host, port):
+        self._server = await asyncio.start_server(self._handle_client, host, port)
+        logger.info("HTTP server listening on %s:%s", host, port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _respond(self, writer, status, payload=b"", content_type="text/plain; charset=utf-8", keep_alive=False):
+        head = (
+            f"HTTP/1.1 {status} {http.HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + payload)
+        await writer.drain()
+
+    async def _handle_client(self, reader, writer):
+        if self._connections >= self.MAX_CONNECTIONS:
+            with contextlib.suppress(Exception):
+                await self._respond(writer, 503, b"busy")
+            writer.close()
+            return
+        self._connections += 1
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, 400, b"bad request")
+                    break
+
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), self.HEADER_TIMEOUT)
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = headers.get("content-length") or "0"
+                if not length.isdigit():
+                    await self._respond(writer, 400, b"bad content-length")
+                    break
+                length = int(length)
+                if length > self.MAX_BODY:
+                    await self._respond(writer, 413, b"payload too large")
+                    break
+                # A client that declares a body and never sends it doesn't get to hold the connection
+                body = await asyncio.wait_for(reader.readexactly(length), self.HEADER_TIMEOUT) if length else b""
+
+                path = target.split("?", 1)[0]
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    known_path = any(p == path for _, p in self.routes)
+                    status, content_type, payload = (405 if known_path else 404), "text/plain; charset=utf-8", b""
+                else:
+                    try:
+                        status, content_type, payload = await handler(headers, body)
+                    except Exception:
+                        logger.exception("HTTP handler for %s %s failed", method, path)
+                        status, content_type, payload = 500, "text/plain; charset=utf-8", b""
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self._respond(writer, status, payload, content_type, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections -= 1
+            writer.close()
+            with contextlib.suppress(Exception):
+                await writer.wait_closed()
+
+
+def make_webhook_handler(application, secret_token):
+    """
+    Accepts Telegram's POSTed Update JSON, checks the secret header and hands
+    the update to the Application's queue, which processes it concurrently.
+    Locally: run with WEBHOOK_URL=http://localhost:8080 WEBHOOK_REGISTER=0 and
+    `curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json localhost:8080/telegram`.
+    """
+    async def handle(headers, body):
+        received = headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            return 403, "text/plain; charset=utf-8", b"forbidden"
+        try:
+            data = json.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("update is not a JSON object")
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return 400, "text/plain; charset=utf-8", b"invalid update"
+        await application.update_queue.put(update)
+        return 200, "text/plain; charset=utf-8", b"ok"
+
+    return handle
+
+
+# Startup progress, reported by /readyz
+READINESS = {"ready": False, "phase": "starting"}
+
+
+async def healthz_endpoint(headers, body):
+    """Liveness: the process is up and its event loop answers."""
+    return 200, "text/plain; charset=utf-8", b"ok"
+
+
+async def readyz_endpoint(headers, body):
+    """Readiness: 200 once updates are being processed, 503 (with the startup phase) before that."""
+    if READINESS["ready"]:
+        return 200, "text/plain; charset=utf-8", b"ready"
+    return 503, "text/plain; charset=utf-8", READINESS["phase"].encode()
+
+
+async def prepare_db():
+    """
+    Schema check/migration, then the pool's warm connections (DB_POOL_WARM,
+    clamped to the pool's minconn..maxconn) opened in parallel.
+    """
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(DB_EXECUTOR, init_db)
+    pool = get_pool()
+    warm = min(max(DB_POOL_WARM, pool.minconn), pool.maxconn)
+    conns = await asyncio.gather(
+        *(loop.run_in_executor(DB_EXECUTOR, pool.getconn) for _ in range(warm)),
+        return_exceptions=True,
+    )
+    errors = [conn for conn in conns if isinstance(conn, BaseException)]
+    for conn in conns:
+        if not isinstance(conn, BaseException):
+            pool.putconn(conn)
+    if errors:
+        raise errors[0]
+
+
+async def run_app(application):
+    """
+    Runs the bot until SIGINT/SIGTERM: webhook mode when WEBHOOK_URL is set,
+    polling otherwise. The HTTP server binds first (in polling mode only if
+    the platform set PORT), so /healthz answers and webhook updates queue up
+    while the schema check, pool warm-up and the Telegram getMe run side by
+    side. /readyz turns 200 once updates are processed. The time spent in
+    each step is logged.
+    """
+    timings = {}
+    started = time.monotonic()
+
+    async def step(name, awaitable):
+        READINESS["phase"] = name
+        step_started = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            timings[name] = time.monotonic() - step_started
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+
+    server = None
+    if WEBHOOK_URL or os.getenv("PORT"):
+        server = HttpServer()
+        server.route("GET", "/healthz", healthz_endpoint)
+        server.route("GET", "/readyz", readyz_endpoint)
+        if METRICS_ENABLED:
+            server.route("GET", "/metrics", metrics_endpoint)
+        if WEBHOOK_URL:
+            server.route("POST", WEBHOOK_PATH, make_webhook_handler(application, WEBHOOK_SECRET))
+        await step("bind", server.start(HTTP_HOST, PORT))
+
+    try:
+        # Independent: Postgres (DDL only when the schema is behind) and getMe
+        await asyncio.gather(step("database", prepare_db()), step("telegram", application.bot.initialize()))
+        # Loads persisted conversation state, so it needs the schema in place
+        await step("initialize", application.initialize())
+        if application.post_init:
+            await step("post_init", application.post_init(application))
+        if WEBHOOK_URL and WEBHOOK_REGISTER:
+            await step("set_webhook", application.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=min(CONCURRENT_UPDATES, 100),
+            ))
+        elif not WEBHOOK_URL:
+            await step("start_polling", application.updater.start_polling(allowed_updates=Update.ALL_TYPES))
+        await step("start", application.start())
+        READINESS.update(ready=True, phase="ready")
+        logger.info(
+            "SmartEarnbdBot ready in %.2fs (%s). %s",
+            time.monotonic() - started,
+            ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()),
+            f"Webhook at {WEBHOOK_URL}{WEBHOOK_PATH}" if WEBHOOK_URL else "Polling...",
+        )
+        await stop.wait()
+    finally:
+        READINESS.update(ready=False, phase="stopping")
+        if server is not None:
+            await server.stop()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+# Background tasks started in post_init (the broadcast resume, the endless
+# logging loops). Application.stop() waits for tasks from
+# application.create_task, so these are cancelled in post_stop instead.
+_periodic_tasks = []
+
+
+async def post_init(application):
+    NOTIFIER.start(application.bot)
+    LEDGER.start()
+    _periodic_tasks.append(asyncio.create_task(resume_broadcasts(application)))
+    if DB_POOL_STATS_INTERVAL > 0:
+        _periodic_tasks.append(asyncio.create_task(log_stats_periodically(DB_POOL_STATS_INTERVAL)))
+    if METRICS_ENABLED and METRICS_LOG_INTERVAL > 0:
+        _periodic_tasks.append(asyncio.create_task(log_metrics_periodically(METRICS_LOG_INTERVAL)))
+
+
+async def post_stop(application):
+    for task in _periodic_tasks:
+        task.cancel()
+    await asyncio.gather(*_periodic_tasks, return_exceptions=True)
+    _periodic_tasks.clear()
+    await stop_broadcasts()
+    await LEDGER.stop()
+    # Flush queued notifications while the bot can still send
+    await NOTIFIER.stop()
+
+
+async def post_shutdown(application):
+    logger.info("DB pool stats at shutdown: %s", get_pool().stats())
+    DB_EXECUTOR.shutdown(wait=True)
+    get_pool().closeall()
+    REPLICA.closeall()
+
+
+def add_handlers(app):
+    """Registers the bot's handlers (shared by run_bot and the benchmarks)."""
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_cmd))
     # Admin commands check if the user is the ADMIN_ID
     app.add_handler(CommandHandler("withdraws", admin_withdraws, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("approve_all", admin_approve_all, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("broadcast", admin_broadcast, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("broadcast_cancel", admin_broadcast_cancel, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("reconcile", admin_reconcile, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("stats", admin_stats, filters=filters.Chat(ADMIN_ID)))
+    app.add_handler(CommandHandler("export", admin_export, filters=filters.Chat(ADMIN_ID)))
 
     app.add_handler(CallbackQueryHandler(callback_query_handler))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), message_router))
 
-    logger.info("SmartEarnbdBot started. Polling...")
-    app.run_polling()
+
+def run_bot():
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN is not set in the .env file.")
+        return
+
+    if not ADMIN_ID:
+         logger.warning("ADMIN_ID is not set in the .env file. Admin commands will not work.")
+
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .persistence(CONVERSATION_STATE)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if METRICS_ENABLED:
+        # Same pool size as the builder's default request
+        builder.request(TimedRequest(connection_pool_size=256))
+    app = builder.build()
+
+    add_handlers(app)
+
+    # Schema check, pool warm-up and Telegram setup happen inside run_app
+    asyncio.run(run_app(app))
+
+
+def run_migrate(dry_run=False):
+    pending = migrate(dry_run=dry_run)
+    if not pending:
+        print("Schema is up to date.")
+        return
+    print("Pending migrations:" if dry_run else "Applied migrations:")
+    for version, description in pending:
+        print(f"  {version:>3}  {description}")
+
+
+def run_reconcile():
+    count, rows = reconcile_balances.sync(limit=1000)
+    if not count:
+        print("All balances match the ledger.")
+        return 0
+    print(f"{count} balance(s) differ from the ledger:")
+    print(f"  {'telegram_id':>15}  {'balance':>10}  {'ledger':>10}")
+    for telegram_id, balance, total in rows:
+        print(f"  {telegram_id:>15}  {balance:>10}  {total:>10}")
+    return 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SmartEarnbdBot")
+    commands = parser.add_subparsers(dest="command")
+    migrate_cmd = commands.add_parser("migrate", help="apply pending schema migrations")
+    migrate_cmd.add_argument("--dry-run", action="store_true", help="print the migration plan without applying it")
+    commands.add_parser("reconcile", help="check users.balance against the balance ledger")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        run_migrate(dry_run=args.dry_run)
+    elif args.command == "reconcile":
+        raise SystemExit(run_reconcile())
+    else:
+        run_bot()
 
 
 if __name__ == "__main__":